@@ -1,13 +1,45 @@
-from threading import Thread, Lock
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+                               as_completed
 from log import Log
+from proxy import FrontDoor
+from supervisor import Supervisor
+from discovery import Workspace
+from watcher import ArchiveWatcher
+from stats import Stats, PORTS
+from cache import ExtractionCache
+from search import TraceSearch
+from store import ContentStore
 import re
 import os
 from cmd import Cmd
 import settings
-from utils import get_next_free_port
+
+def _extract_in_process(node_name, archive, app_settings):
+    """Extract a node archive inside a worker process.
+
+    Arguments:
+        node_name {str} -- The name of the node.
+        archive {str} -- The name of the archive for the node.
+        app_settings {Settings} -- The settings of the parent process.
+
+    Returns:
+        dict -- The stats of the node, to be merged in the parent process.
+    """
+
+    # Worker processes don't inherit the settings when they are spawned.
+    if settings.settings is None:
+        settings.settings = app_settings
+
+    # Forked workers start with a copy of the parent's counters.
+    stats = Stats.get_instance()
+    stats.pop(node_name.capitalize())
+    Log(node_name, archive).extract()
+    return stats.pop(node_name.capitalize())
 
 class App(Cmd):
-    COMMANDS = ['oscilloscope', 'exit', 'kill']
+    COMMANDS = ['oscilloscope', 'exit', 'kill', 'status', 'stats', 'search',
+                'recompress']
 
     prompt = '> '
     intro = 'CLI started'
@@ -23,6 +55,9 @@ class App(Cmd):
         else:
             super().__init__()
             self.logs = {}
+            self.front_door = None
+            self.watcher = None
+            self.searcher = TraceSearch(settings.settings.jobs)
             App._next_free_port = settings.settings.first_port
             App.__instance = self
 
@@ -60,17 +95,20 @@ class App(Cmd):
             App -- self
         """
 
-        # Match on folders based on the folder format given, placing a group in
-        # order to get the name of the node.  Append a look-behind at the end
-        # to exclude the archives, if they exist and match on the pattern.
-        folder_format = settings.settings.folder_format
-        p = re.compile((folder_format % r'(.*)') + r'(?<!\.tgz)$')
-        existing_logs = filter(lambda x: p.match(x), os.listdir())
+        # The workspace is scanned once for both the node folders and the
+        # archives.
+        workspace = Workspace.get_instance().scan(Log.ARCHIVE_REGEX)
+        archived_nodes = set(x.lower() for x in workspace.archives.values())
 
-        # Create the Log objects and map their locations.
-        for log in existing_logs:
-            log = Log(p.match(log).group(1))
+        # Create the Log objects and map their locations.  Partial extractions
+        # are repaired by extract_archives if their archive is still present.
+        for node_name in workspace.folders.values():
+            log = Log(node_name)
             self.logs[log.node_name.lower()] = log
+            if not log.is_complete() \
+                    and log.node_name.lower() not in archived_nodes:
+                print('Extraction of node {} is incomplete and its archive '
+                      'is missing.'.format(log.node_name))
 
         return self
 
@@ -81,40 +119,144 @@ class App(Cmd):
             App -- self
         """
 
-        # Get all the archives matching the given pattern
-        p = Log.ARCHIVE_REGEX
-        archives = filter(lambda x: p.match(x), os.listdir())
+        # Get all the archives matching the given pattern, largest first so
+        # the longest extractions don't end up being started last.
+        workspace = Workspace.get_instance().scan(Log.ARCHIVE_REGEX)
+        archives = sorted(workspace.archives, key=os.path.getsize,
+                          reverse=True)
+
+        if not archives:
+            return self
+
+        # In lazy mode the archives are only indexed.  The indexes hold
+        # decompressor states which can't leave the process, so threads are
+        # always used.
+        lazy = settings.settings.lazy
+        use_processes = settings.settings.use_processes and not lazy
+        jobs = settings.settings.jobs or os.cpu_count() or 1
+        if settings.settings.verbose_level > 0:
+            print('{} {} archives using {} {}...'.format(
+                'Indexing' if lazy else 'Extracting', len(archives), jobs,
+                'processes' if use_processes else 'threads'))
+
+        # Build the Log objects and queue them on a bounded pool.  Processes
+        # can't share the Log objects, so they extract on their own copy and
+        # the locations are mapped again here once they are done.
+        if use_processes:
+            executor = ProcessPoolExecutor(max_workers=jobs)
+        else:
+            executor = ThreadPoolExecutor(max_workers=jobs)
+
+        with executor:
+            futures = {}
+            for arch in archives:
+                log = Log(workspace.archives[arch], arch)
+                self.logs[log.node_name.lower()] = log
+                if lazy:
+                    future = executor.submit(log.load_index)
+                elif use_processes:
+                    future = executor.submit(_extract_in_process,
+                                             log.node_name, arch,
+                                             settings.settings)
+                else:
+                    future = executor.submit(log.extract)
+                futures[future] = log
+
+            for done, future in enumerate(as_completed(futures), 1):
+                log = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print('Failed to {} {}: {}'.format(
+                        'index' if lazy else 'extract', log.archive, e))
+                    continue
+
+                if use_processes:
+                    Stats.get_instance().merge(log.node_name, result)
+                    archive = log.archive \
+                              if os.path.exists(log.archive) else None
+                    log = Log(log.node_name, archive)
+                    self.logs[log.node_name.lower()] = log
+
+                if settings.settings.verbose_level > 0:
+                    print('{} {} ({}/{}).'.format(
+                        'Indexed' if lazy else 'Extracted', log.node_name,
+                        done, len(futures)))
 
         if settings.settings.verbose_level > 0:
-            print('Extracting archives...')
+            print('{} complete.'.format('Indexing' if lazy else 'Extraction'))
+        
+        return self
 
-        # Build the Log objects and start threads to extract them
-        threads = []
-        for arch in archives:
-            log = Log(p.match(arch).group(1), arch)
-            self.logs[log.node_name.lower()] = log
-            threads.append(Thread(target=log.extract))
-            threads[-1].start()
+    def ingest_archive(self, archive):
+        """Extract, or index in lazy mode, an archive which appeared while the
+        CLI is running and register its node once it's ready.
+
+        Arguments:
+            archive {str} -- The name of the archive.
+
+        Returns:
+            App -- self
+        """
+
+        log = Log(Log.ARCHIVE_REGEX.match(archive).group(1), archive)
 
-        for t in threads:
-            t.join()
+        # The oscilloscopes of a replaced node would lose their files.
+        old_log = self.logs.get(log.node_name.lower())
+        if old_log is not None:
+            old_log.stop_osc(None)
 
         if settings.settings.verbose_level > 0:
-            print('Extraction complete.')
-        
+            print('New archive {} found.'.format(archive))
+        if settings.settings.lazy:
+            log.load_index()
+        else:
+            log.extract()
+        self.logs[log.node_name.lower()] = log
+        ExtractionCache.get_instance().enforce()
+        if settings.settings.verbose_level > 0:
+            print('Node {} ready with {} locations.'.format(
+                log.node_name, len(log.locations)))
+
+        if settings.settings.start_all:
+            log.start_osc(None)
+
         return self
 
     def preloop(self):
         """Hook method executed once when the cmdloop() method is called."""
 
         self.load_existing_logs().extract_archives()
+        Workspace.get_instance().save()
+        ExtractionCache.get_instance().track(self.logs).enforce()
+        if settings.settings.dedup:
+            freed = ContentStore.get_instance().prune()
+            if freed and settings.settings.verbose_level > 1:
+                print('Pruned {:.1f} MiB of unused stored files.'.format(
+                    freed / 1024 / 1024))
+
+        if settings.settings.proxy:
+            self.front_door = FrontDoor(self.logs, settings.settings.first_port,
+                                        settings.settings.idle_timeout).start()
 
         if settings.settings.start_all:
             self.do_oscilloscope(None)
 
+        if settings.settings.watch:
+            self.watcher = ArchiveWatcher(self).start()
+
     def postloop(self):
-        for node in self.logs.values():
-            node.stop_osc(None)
+        if self.watcher is not None:
+            self.watcher.stop()
+
+        if self.front_door is not None:
+            self.front_door.stop()
+
+        Supervisor.get_instance().shutdown(
+            [location for node in list(self.logs.values())
+             for location in node.locations.values()])
+        ExtractionCache.get_instance().save()
+        self.searcher.close()
 
     def parseline(self, line):
         """Parse the line into a command name and a string containing the
@@ -205,18 +347,15 @@ class App(Cmd):
         # locations.
         if not args:
             log_dicts = map(lambda x: {'node': x, 'location_id': None},
-                            self.logs.keys())
+                            list(self.logs.keys()))
         else:
             log_dicts = self.__parse_node_args(args)
 
-        # Start oscilloscope on the matching node-location pairs.
-        threads = []
+        # Queue the start of oscilloscope on the matching node-location
+        # pairs.  The launches run in the background, so the CLI stays
+        # available while they load.
         for log_dict in log_dicts:
-            threads.append(Thread(target=self.start_osc,
-                                  args=(log_dict.values())))
-            threads[-1].start()
-        for t in threads:
-            t.join()
+            self.start_osc(*log_dict.values())
 
         return False
 
@@ -246,11 +385,224 @@ class App(Cmd):
 
         if args is not None:
             log_dicts = self.__parse_node_args(args)
-            
+
+            # The locations are stopped together, so a slow one doesn't hold
+            # up the others.
+            locations = []
             for log in log_dicts:
                 try:
-                    self.logs[log['node'].lower()].stop_osc(log['location_id'])
+                    node = self.logs[log['node'].lower()]
                 except KeyError:
                     print('Node {} does not exist.'\
                                              .format(log['node'].capitalize()))
-        return False
\ No newline at end of file
+                    continue
+
+                if log['location_id'] is None:
+                    locations.extend(node.locations.values())
+                    continue
+                try:
+                    location = node.locations[log['location_id'].lower()]
+                except KeyError:
+                    print('Location {} does not exist on node {}.'\
+                          .format(log['location_id'].capitalize(),
+                                  node.node_name.capitalize()))
+                    continue
+                if location.osc_proc is None and location.osc_task is None:
+                    print('Oscilloscope not running on {}.{}'.format(
+                        node.node_name, location.id))
+                locations.append(location)
+
+            Supervisor.get_instance().stop_all(locations)
+        return False
+
+    def do_status(self, args):
+        """\
+        Show the state of the started oscilloscope processes: loading, ready
+        or dead, along with their port and the time they took to load.
+        """
+
+        for log in sorted(list(self.logs.values()),
+                          key=lambda x: x.node_name):
+            for location in sorted(log.locations.values(),
+                                   key=lambda x: int(x.id)):
+                if location.osc_state is None:
+                    continue
+                load_time = '{:.1f}s'.format(location.osc_load_time) \
+                            if location.osc_load_time is not None else '-'
+                print('{}.{}\t{}\t{}\t{}'.format(log.node_name, location.id,
+                                                 location.osc_state,
+                                                 location.port, load_time))
+        return False
+
+    def do_stats(self, args):
+        """\
+        Show where the time went: for each node the extraction time and
+        throughput, along with the time spent writing the files, removing
+        old folders and mapping the locations and the MiB saved by
+        deduplication, then for each location the time waiting for a loading
+        slot, warming its trace files and from launch until oscilloscope is
+        ready.
+
+        Arguments:
+            args {str} -- 'json [path]' exports all the counters to a JSON
+                          file instead (default path: untar_stats.json).
+        """
+
+        stats = Stats.get_instance()
+        args = args.split()
+        if args and args[0] == 'json':
+            path = args[1] if len(args) > 1 else 'untar_stats.json'
+            try:
+                stats.save(path)
+                print('Stats written to {}.'.format(path))
+            except OSError as e:
+                print('Could not write {}: {}'.format(path, e))
+            return False
+
+        def seconds(phases, phase):
+            if phase not in phases:
+                return '-'
+            return '{:.2f}s'.format(phases[phase]['seconds'])
+
+        def mean(phases, phase):
+            if phase not in phases:
+                return '-'
+            return '{:.2f}s'.format(phases[phase]['seconds']
+                                    / phases[phase]['count'])
+
+        print('Node\tExtract\tMiB\tMiB/s\tWrite\tRmtree\tIndex\tMap\tDedup')
+        for log in sorted(list(self.logs.values()),
+                          key=lambda x: x.node_name):
+            phases = stats.get(log.node_name)
+            written = phases.get('write', {}).get('bytes', 0) / 1024 / 1024
+            extract_time = phases.get('extract', {}).get('seconds', 0)
+            rate = '{:.1f}'.format(written / extract_time) \
+                   if extract_time > 0 else '-'
+            dedup = '{:.1f}'.format(phases['dedup']['bytes'] / 1024 / 1024) \
+                    if 'dedup' in phases else '-'
+            print('{}\t{}\t{:.1f}\t{}\t{}\t{}\t{}\t{}\t{}'.format(
+                log.node_name, seconds(phases, 'extract'), written, rate,
+                seconds(phases, 'write'), seconds(phases, 'rmtree'),
+                seconds(phases, 'index'), seconds(phases, 'map_locations'),
+                dedup))
+
+        print('\nLocation\tStarts\tQueue\tPrefetch\tExtract\tReady\tStop')
+        for log in sorted(list(self.logs.values()),
+                          key=lambda x: x.node_name):
+            for location in sorted(log.locations.values(),
+                                   key=lambda x: int(x.id)):
+                phases = stats.get('{}.{}'.format(log.node_name, location.id))
+                if not phases:
+                    continue
+                print('{}.{}\t\t{}\t{}\t{}\t\t{}\t{}\t{}'.format(
+                    log.node_name, location.id,
+                    phases.get('ready', {}).get('count', 0),
+                    mean(phases, 'queue_wait'), mean(phases, 'prefetch'),
+                    seconds(phases, 'extract'),
+                    mean(phases, 'ready'), mean(phases, 'stop')))
+
+        ports = stats.get(PORTS).get('allocate')
+        if ports is not None:
+            print('\n{} ports allocated in {:.1f}ms.'.format(
+                ports['count'], ports['seconds'] * 1000))
+        return False
+
+    def do_search(self, args):
+        """\
+        Search the trace files of all locations and list the locations with
+        matches, most matches first.  Locations which aren't extracted yet
+        are skipped.
+
+        Arguments:
+            args {str} -- The searched text, optionally preceded by:
+                          -r to search a regular expression instead,
+                          -i to ignore the case,
+                          -o to start oscilloscope on the matching
+                          locations.
+
+                          Examples: '-i link failure', '-r -o 12:3[0-9]:'.
+        """
+
+        options = set()
+        words = (args or '').split(' ')
+        while words and words[0] in ('-r', '-i', '-o'):
+            options.add(words.pop(0))
+        text = ' '.join(words).strip()
+        if not text:
+            print('Nothing to search for.')
+            return False
+
+        try:
+            pattern, flags = TraceSearch.compile(text, '-r' in options,
+                                                 '-i' in options)
+        except re.error as e:
+            print('Invalid regular expression: {}'.format(e))
+            return False
+
+        locations = [location for log in list(self.logs.values())
+                     for location in log.locations.values()]
+        results, skipped = self.searcher.search(locations, pattern, flags)
+
+        for location, hits in results:
+            print('{}.{}\t{} hits'.format(location.log.node_name,
+                                          location.id, hits))
+        if not results:
+            print('No matches found.')
+        if skipped:
+            print('{} locations are not extracted and were skipped.'.format(
+                skipped))
+
+        if '-o' in options and results:
+            self.do_oscilloscope(' '.join(
+                '{}.{}'.format(location.log.node_name, location.id)
+                for location, _ in results))
+        return False
+
+    def do_recompress(self, args):
+        """\
+        Convert the kept archives to seekable zstd, which extracts several
+        times faster than gzip.  The old archives are replaced and their
+        extractions stay valid.
+
+        Arguments:
+            args {str} -- The nodes whose archive is converted, separated by
+                          empty spaces.  If empty, all the kept archives are
+                          converted.
+
+                          Examples: 'ap b'.
+        """
+
+        if args:
+            nodes = [x.lower() for x in args.split(' ') if x]
+        else:
+            nodes = list(self.logs.keys())
+
+        for node in nodes:
+            log = self.logs.get(node)
+            if log is None:
+                print('Node {} does not exist.'.format(node.capitalize()))
+                continue
+            if log.archive is None or not os.path.exists(log.archive):
+                if args:
+                    print('The archive of node {} was not kept.'.format(
+                        log.node_name))
+                continue
+
+            old_archive = log.archive
+            old_size = os.path.getsize(old_archive)
+            try:
+                if not log.recompress():
+                    if args:
+                        print('The archive of node {} is already seekable '
+                              'zstd.'.format(log.node_name))
+                    continue
+            except Exception as e:
+                print('Failed to recompress {}: {}'.format(log.archive, e))
+                continue
+            if self.watcher is not None:
+                self.watcher.ignore(log.archive)
+            print('Recompressed {} to {} ({:.1f} MiB -> {:.1f} MiB).'.format(
+                old_archive, log.archive, old_size / 1024 / 1024,
+                os.path.getsize(log.archive) / 1024 / 1024))
+
+        return False
@@ -0,0 +1,415 @@
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import shutil
+import stat
+import string
+import sys
+import tarfile
+import tempfile
+import time
+import settings
+from settings import Settings
+import utils
+
+FAKE_OSC = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'fake_oscilloscope.py')
+PHASES = ('extract_archives', 'load_existing_logs', 'oscilloscope',
+          'postloop')
+PERCENTILES = (50, 90, 99)
+BLOCK_SIZE = 64 * 1024
+# Slowdowns below this many seconds are noise, whatever their ratio.
+MIN_REGRESSION = 0.005
+
+def node_names(count):
+    """Generate node names: A, B, ..., Z, Aa, Ab, ...
+
+    Arguments:
+        count {int} -- Number of names.
+
+    Returns:
+        list -- The names.
+    """
+
+    names = []
+    letters = string.ascii_lowercase
+    for i in range(count):
+        name = ''
+        while True:
+            name = letters[i % len(letters)] + name
+            i = i // len(letters) - 1
+            if i < 0:
+                break
+        names.append(name.capitalize())
+    return names
+
+def trace_data(rng, size, compressibility):
+    """Generate trace contents, each block made of random bytes followed by
+    a run of repeated text.
+
+    Arguments:
+        rng {random.Random} -- The random generator.
+        size {int} -- Size of the data in bytes.
+        compressibility {float} -- Fraction of each block which is repeated
+                                   text, between 0 and 1.
+
+    Returns:
+        bytes -- The data.
+    """
+
+    text = b'0123456789 ipstrc sample; '
+    chunks = []
+    while size > 0:
+        block = min(BLOCK_SIZE, size)
+        repeated = int(block * compressibility)
+        chunks.append(rng.getrandbits(8 * (block - repeated))
+                      .to_bytes(block - repeated, 'little'))
+        chunks.append((text * (repeated // len(text) + 1))[:repeated])
+        size -= block
+    return b''.join(chunks)
+
+def generate_workspace(path, nodes=4, locations=4, trace_size=4 * 1024 * 1024,
+                       compressibility=0.5, seed=0, archive_format='tgz'):
+    """Write synthetic node archives into a directory.  Each location holds
+    both trace files, sharing the trace size, and a non-trace file.
+
+    Arguments:
+        path {str} -- The workspace directory.
+
+    Keyword Arguments:
+        nodes {int} -- Number of node archives. (default: {4})
+        locations {int} -- Number of locations per node. (default: {4})
+        trace_size {int} -- Size of the traces of a location in bytes.
+                            (default: {4 MiB})
+        compressibility {float} -- Fraction of the trace data which is
+                                   repeated text. (default: {0.5})
+        seed {int} -- Seed of the random data. (default: {0})
+        archive_format {str} -- 'tgz' for gzipped archives, 'tar' for
+                                uncompressed ones. (default: {'tgz'})
+
+    Returns:
+        int -- Total size of the archives in bytes.
+    """
+
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    total = 0
+    for node in node_names(nodes):
+        archive = os.path.join(path, 'node{}_log.{}'.format(node,
+                                                            archive_format))
+        if archive_format == 'tgz':
+            tar = tarfile.open(archive, 'w:gz', compresslevel=6)
+        else:
+            tar = tarfile.open(archive, 'w')
+        with tar:
+            for location in range(1, locations + 1):
+                folder = './location{}/'.format(location)
+                files = (('ipstrc.drw', trace_size - trace_size // 4),
+                         ('ipstrc.dmp', trace_size // 4),
+                         ('syslog.txt', 16 * 1024))
+                for name, size in files:
+                    info = tarfile.TarInfo(folder + name)
+                    info.size = size
+                    info.mtime = 0
+                    tar.addfile(info, io.BytesIO(
+                        trace_data(rng, size, compressibility)))
+        total += os.path.getsize(archive)
+    return total
+
+def write_stub(path, delay):
+    """Write an oscilloscope.exe stand-in running the fake oscilloscope with
+    the given load delay.
+
+    Arguments:
+        path {str} -- The directory of the stub.
+        delay {float} -- Seconds before the stub starts listening.
+
+    Returns:
+        str -- The path of the stub.
+    """
+
+    if os.name == 'nt':
+        stub = os.path.join(path, 'oscilloscope.bat')
+        with open(stub, 'w') as f:
+            f.write('@"{}" "{}" --delay {} %*\n'.format(sys.executable,
+                                                       FAKE_OSC, delay))
+    else:
+        stub = os.path.join(path, 'oscilloscope.exe')
+        with open(stub, 'w') as f:
+            f.write('#!/bin/sh\nexec "{}" "{}" --delay {} "$@"\n'.format(
+                sys.executable, FAKE_OSC, delay))
+        os.chmod(stub, os.stat(stub).st_mode | stat.S_IXUSR)
+    return stub
+
+def percentile(values, p):
+    """Get the nearest-rank percentile of the values.
+
+    Arguments:
+        values {list} -- The values.
+        p {float} -- The percentile, between 0 and 100.
+
+    Returns:
+        float -- The percentile.
+    """
+
+    values = sorted(values)
+    rank = max(math.ceil(p / 100 * len(values)), 1)
+    return values[rank - 1]
+
+def reset_singletons():
+    """Forget the App and Workspace instances, so each phase starts as a
+    fresh run of the CLI would."""
+
+    from app import App
+    from discovery import Workspace
+    App._App__instance = None
+    Workspace._Workspace__instance = None
+
+def wait_ready(app, timeout):
+    """Wait until every location's oscilloscope is ready or dead.
+
+    Arguments:
+        app {App} -- The application.
+        timeout {float} -- Maximum number of seconds to wait.
+
+    Returns:
+        int -- Number of ready oscilloscopes.
+    """
+
+    from supervisor import READY, DEAD
+    locations = [location for log in app.logs.values()
+                 for location in log.locations.values()]
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        states = [x.osc_state for x in locations]
+        if all(state in (READY, DEAD) for state in states):
+            break
+        time.sleep(0.01)
+    return sum(1 for x in locations if x.osc_state == READY)
+
+def run_once(template, workdir, expected):
+    """Run every phase on a fresh copy of the workspace.
+
+    Arguments:
+        template {str} -- The generated workspace.
+        workdir {str} -- Directory where the copy is made.
+        expected {int} -- Number of oscilloscopes which must become ready.
+
+    Raises:
+        Exception: Fewer oscilloscopes became ready than expected.
+
+    Returns:
+        dict -- The duration of each phase in seconds.
+    """
+
+    from app import App
+    run_dir = os.path.join(workdir, 'run')
+    shutil.copytree(template, run_dir)
+    cwd = os.getcwd()
+    os.chdir(run_dir)
+    times = {}
+    try:
+        reset_singletons()
+        app = App()
+        started = time.perf_counter()
+        app.extract_archives()
+        times['extract_archives'] = time.perf_counter() - started
+
+        reset_singletons()
+        app = App()
+        started = time.perf_counter()
+        if settings.settings.lazy:
+            # Nothing is extracted yet, the nodes are known from their saved
+            # indexes.
+            app.extract_archives()
+        else:
+            app.load_existing_logs()
+        times['load_existing_logs'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        app.do_oscilloscope(None)
+        ready = wait_ready(app, settings.settings.ready_timeout)
+        times['oscilloscope'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        app.postloop()
+        times['postloop'] = time.perf_counter() - started
+
+        if ready != expected:
+            raise Exception('Only {} of {} oscilloscopes became ready.'
+                            .format(ready, expected))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+    return times
+
+def summarize(runs, archive_bytes, nodes, locations):
+    """Compute the statistics of each phase.
+
+    Arguments:
+        runs {list} -- The phase durations of each run.
+        archive_bytes {int} -- Total size of the archives.
+        nodes {int} -- Number of nodes.
+        locations {int} -- Number of locations per node.
+
+    Returns:
+        dict -- The statistics, by phase.
+    """
+
+    # The work each phase does, for its throughput.
+    work = {'extract_archives': (archive_bytes / 1024 / 1024, 'MiB/s'),
+            'load_existing_logs': (nodes, 'nodes/s'),
+            'oscilloscope': (nodes * locations, 'oscilloscopes/s'),
+            'postloop': (nodes * locations, 'oscilloscopes/s')}
+
+    summary = {}
+    for phase in PHASES:
+        values = [run[phase] for run in runs]
+        mean = sum(values) / len(values)
+        stats = {'mean': mean, 'min': min(values), 'max': max(values)}
+        for p in PERCENTILES:
+            stats['p{}'.format(p)] = percentile(values, p)
+        amount, unit = work[phase]
+        stats['throughput'] = amount / mean if mean > 0 else float('inf')
+        stats['unit'] = unit
+        summary[phase] = stats
+    return summary
+
+def report(summary, baseline=None, tolerance=0.1):
+    """Print the statistics, compared to the baseline if any.
+
+    Arguments:
+        summary {dict} -- The statistics, by phase.
+
+    Keyword Arguments:
+        baseline {None, dict} -- The statistics of the baseline.
+                                 (default: {None})
+        tolerance {float} -- Relative slowdown of the median allowed before
+                             a phase counts as a regression. (default: {0.1})
+
+    Returns:
+        list -- The phases which regressed.
+    """
+
+    regressions = []
+    print('{:<20}{:>10}{:>10}{:>10}{:>10}  {:<26}{:>10}'.format(
+        'phase', 'mean', 'p50', 'p90', 'p99', 'throughput', 'vs base'))
+    for phase in PHASES:
+        stats = summary[phase]
+        change = ''
+        if baseline is not None and phase in baseline:
+            base = baseline[phase]['p50']
+            if base > 0:
+                ratio = stats['p50'] / base - 1
+                change = '{:+.1%}'.format(ratio)
+                if ratio > tolerance \
+                        and stats['p50'] - base > MIN_REGRESSION:
+                    regressions.append(phase)
+                    change += ' !'
+        throughput = '{:.1f} {}'.format(stats['throughput'], stats['unit'])
+        print('{:<20}{:>9.3f}s{:>9.3f}s{:>9.3f}s{:>9.3f}s  {:<26}{:>10}'
+              .format(phase, stats['mean'], stats['p50'], stats['p90'],
+                      stats['p99'], throughput, change))
+    return regressions
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Benchmark extraction and oscilloscope launches on a synthetic workspace, using a fake oscilloscope.')
+    parser.prog = "benchmark.py"
+
+    parser.add_argument("--nodes", '-n', default=4, type=int, help="Number of node archives (default: %(default)s)")
+    parser.add_argument("--locations", '-L', default=4, type=int, help="Number of locations per node (default: %(default)s)")
+    parser.add_argument("--trace-size", default=4.0, type=float, help="Size of the traces of each location, in MiB (default: %(default)s)")
+    parser.add_argument("--compressibility", default=0.5, type=float, help="Fraction of the trace data which compresses well, between 0 and 1 (default: %(default)s)")
+    parser.add_argument("--format", default='tgz', choices=['tgz', 'tar'], help="Compression of the generated archives (default: %(default)s)")
+    parser.add_argument("--seed", default=0, type=int, help="Seed of the generated data (default: %(default)s)")
+    parser.add_argument("--load-delay", default=0.5, type=float, help="Seconds the fake oscilloscope takes before listening (default: %(default)s)")
+    parser.add_argument("--repeat", '-r', default=5, type=int, help="Number of runs (default: %(default)s)")
+    parser.add_argument("--port", '-p', default=18080, type=int, help="First port to use")
+    parser.add_argument("--jobs", '-j', default=None, type=int, help="Number of archives extracted at the same time (default: number of CPUs)")
+    parser.add_argument("--processes", action="store_true", help="Extract archives in worker processes instead of threads")
+    parser.add_argument("--lazy", '-l', action="store_true", help="Only index the archives and extract the locations when their oscilloscope starts")
+    parser.add_argument("--max-loading", default=None, type=int, help="Number of oscilloscopes loading at the same time (default: half the number of CPUs)")
+    parser.add_argument("--prefetch-memory", default=0.5, type=float, help="Share of the available memory used to warm the trace files ahead of the oscilloscopes, 0 to disable (default: %(default)s)")
+    parser.add_argument("--workdir", default=None, help="Directory for the generated workspace (default: a temporary directory)")
+    parser.add_argument("--output", '-o', default=None, help="Write the results to this JSON file")
+    parser.add_argument("--baseline", default=None, help="Compare the results with this JSON file")
+    parser.add_argument("--save-baseline", default=None, help="Write the results to this JSON file as the new baseline")
+    parser.add_argument("--tolerance", default=0.1, type=float, help="Relative slowdown of a median allowed before it counts as a regression (default: %(default)s)")
+    parser.add_argument("--verbose", '-v', action="store_true", help="Show the output of the CLI while running")
+
+    return parser
+
+def main():
+    args = build_parser().parse_args()
+    workdir = args.workdir or tempfile.mkdtemp(prefix='untar-bench-')
+    template = os.path.join(workdir, 'workspace')
+    shutil.rmtree(template, ignore_errors=True)
+
+    print('Generating {} nodes with {} locations of {} MiB...'.format(
+        args.nodes, args.locations, args.trace_size))
+    archive_bytes = generate_workspace(
+        template, args.nodes, args.locations,
+        int(args.trace_size * 1024 * 1024), args.compressibility, args.seed,
+        args.format)
+    stub = write_stub(workdir, args.load_delay)
+
+    settings.settings = Settings(first_port=args.port,
+                                 osc_path=stub,
+                                 verbose_level=1 if args.verbose else 0,
+                                 jobs=args.jobs,
+                                 use_processes=args.processes,
+                                 lazy=args.lazy,
+                                 max_loading=args.max_loading,
+                                 ready_timeout=60,
+                                 prefetch_memory=args.prefetch_memory)
+    # The URLs are handed to a no-op instead of a browser.
+    settings.settings._browser_start_string = 'echo '
+    utils.init()
+
+    expected = args.nodes * args.locations
+    runs = []
+    for i in range(args.repeat):
+        if args.verbose:
+            runs.append(run_once(template, workdir, expected))
+        else:
+            with contextlib.redirect_stdout(io.StringIO()):
+                runs.append(run_once(template, workdir, expected))
+        print('Run {}/{}: {}'.format(i + 1, args.repeat, ', '.join(
+            '{} {:.3f}s'.format(k, v) for k, v in runs[-1].items())))
+
+    summary = summarize(runs, archive_bytes, args.nodes, args.locations)
+    results = {'parameters': {k: v for k, v in vars(args).items()
+                              if k not in ('output', 'baseline',
+                                           'save_baseline', 'workdir')},
+               'archive_bytes': archive_bytes,
+               'runs': runs,
+               'summary': summary}
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('parameters') != results['parameters']:
+            print('Warning: the baseline was recorded with other parameters.')
+    regressions = report(summary, baseline and baseline['summary'],
+                         args.tolerance)
+
+    for path in (args.output, args.save_baseline):
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=2)
+
+    if args.workdir is None:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if regressions:
+        print('Regressions: {}'.format(', '.join(regressions)))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
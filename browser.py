@@ -0,0 +1,128 @@
+import asyncio
+import html
+import os
+import pathlib
+import subprocess
+import settings
+from shutdown import GROUP_OPTIONS, ShutdownManager
+
+INDEX_FILE = 'oscilloscopes.html'
+INDEX_REFRESH = 5
+
+TABS = 'tabs'
+INDEX = 'index'
+
+class BrowserLauncher(object):
+    """Open oscilloscope URLs in the browser in batches.  The URLs which get
+    ready within a short window are opened by a single browser invocation,
+    or, in index mode, listed on a local page opened only once."""
+
+    def __init__(self, mode=TABS, window=0.5):
+        """BrowserLauncher constructor.
+
+        Keyword Arguments:
+            mode {str} -- TABS to open every URL in its own tab, INDEX to
+                          open a single page linking all of them.
+                          (default: {TABS})
+            window {float} -- Seconds during which the URLs are collected
+                              before the browser is started.
+                              (default: {0.5})
+        """
+
+        super().__init__()
+        self.mode = mode
+        self.window = window
+        self.index_path = os.path.abspath(INDEX_FILE)
+        self.procs = []
+        self.__pending = []
+        self.__entries = {}
+        self.__flush_handle = None
+        self.__index_opened = False
+
+    def open(self, label, url):
+        """Queue an URL to be opened.  Must be called on the event loop.
+
+        Arguments:
+            label {str} -- The name shown for the URL, as {node}.{location}.
+            url {str} -- The URL.
+        """
+
+        self.__entries[label] = url
+        self.__pending.append(url)
+        if self.__flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self.__flush_handle = loop.call_later(
+                self.window, lambda: loop.create_task(self.__flush()))
+
+    def remove(self, label):
+        """Drop an URL which isn't served anymore from the index page.  Must
+        be called on the event loop.
+
+        Arguments:
+            label {str} -- The name of the URL.
+        """
+
+        if self.__entries.pop(label, None) is not None and self.mode == INDEX \
+                and self.__index_opened:
+            self.__write_index()
+
+    async def __flush(self):
+        self.__flush_handle = None
+        urls, self.__pending = self.__pending, []
+
+        if self.mode == INDEX:
+            self.__write_index()
+            if self.__index_opened:
+                return
+            self.__index_opened = True
+            urls = [pathlib.Path(self.index_path).as_uri()]
+
+        if urls:
+            await self.__start_browser(urls)
+
+    async def __start_browser(self, urls):
+        start = settings.settings._browser_start_string
+
+        # Edge is opened through its protocol handler, which only takes one
+        # URL, so its commands are chained in the same shell instead.
+        if settings.settings.browser == 'edge':
+            browser_cmd = ' & '.join(start + url for url in urls)
+        else:
+            browser_cmd = start + ' '.join(urls)
+
+        if settings.settings.verbose_level > 1:
+            print('Opening {} URLs in the browser.'.format(len(urls)))
+        proc = await asyncio.create_subprocess_shell(
+            browser_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT,
+            **GROUP_OPTIONS)
+        self.procs.append(proc)
+        ShutdownManager.get_instance().track(proc)
+
+        # Reap the shell once the browser is handed the URLs.  A shell still
+        # running at shutdown is stopped with the oscilloscopes.
+        await proc.wait()
+        self.procs.remove(proc)
+        ShutdownManager.get_instance().forget(proc)
+
+    def close(self):
+        """Drop the URLs waiting to be opened.  Must be called on the event
+        loop.
+        """
+
+        if self.__flush_handle is not None:
+            self.__flush_handle.cancel()
+            self.__flush_handle = None
+        self.__pending = []
+
+    def __write_index(self):
+        rows = ''.join('<li><a href="{0}" target="_blank">{1}</a></li>\n'
+                       .format(html.escape(url), html.escape(label))
+                       for label, url in sorted(self.__entries.items()))
+        page = ('<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+                '<meta http-equiv="refresh" content="{}">'
+                '<title>Oscilloscopes</title></head>\n<body>'
+                '<h1>Oscilloscopes</h1>\n<ul>\n{}</ul></body></html>\n'
+                .format(INDEX_REFRESH, rows))
+        with open(self.index_path + '.tmp', 'w') as f:
+            f.write(page)
+        os.replace(self.index_path + '.tmp', self.index_path)
@@ -0,0 +1,209 @@
+import json
+import os
+import time
+from threading import Lock
+import settings
+
+# Kept out of the workspace folder itself, whose mtime validates the
+# discovery snapshot.
+CACHE_FILE = os.path.join('.untar', 'cache.json')
+# Seconds between two writes of the view times.
+SAVE_INTERVAL = 60
+
+class ExtractionCache(object):
+    """Keep the extracted locations within a disk budget by evicting the
+    ones viewed least recently.  The archives are kept, so an evicted
+    location is extracted again the next time its oscilloscope starts."""
+
+    __instance = None
+    __instance_lock = Lock()
+
+    def __init__(self, path='.'):
+        """ExtractionCache constructor.
+
+        Keyword Arguments:
+            path {str} -- The workspace directory. (default: {'.'})
+        """
+
+        if ExtractionCache.__instance is not None:
+            raise Exception('This class is a singleton!')
+
+        super().__init__()
+        self.path = path
+        self.budget = settings.settings.cache_budget
+        self.logs = {}
+        self.__viewed = {}
+        self.__sizes = {}
+        self.__saved = time.monotonic()
+        self.__lock = Lock()
+        self.__evict_lock = Lock()
+        self.__load()
+        ExtractionCache.__instance = self
+
+    @classmethod
+    def get_instance(cls):
+        """Get the ExtractionCache instance.
+
+        Returns:
+            ExtractionCache -- the ExtractionCache instance
+        """
+
+        with cls.__instance_lock:
+            if cls.__instance is None:
+                cls()
+        return cls.__instance
+
+    def __load(self):
+        try:
+            with open(os.path.join(self.path, CACHE_FILE)) as f:
+                self.__viewed = dict(json.load(f)['viewed'])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def save(self):
+        """Write the view times of the locations, if there's a budget to
+        enforce.
+
+        Returns:
+            ExtractionCache -- self
+        """
+
+        if self.budget is None:
+            return self
+
+        with self.__lock:
+            viewed = dict(self.__viewed)
+            self.__saved = time.monotonic()
+        path = os.path.join(self.path, CACHE_FILE)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'w') as f:
+                json.dump({'viewed': viewed}, f)
+            os.replace(path + '.tmp', path)
+        except OSError:
+            pass
+
+        return self
+
+    def track(self, logs):
+        """Set the nodes whose locations are managed.
+
+        Arguments:
+            logs {dict} -- The node logs, by node name.
+
+        Returns:
+            ExtractionCache -- self
+        """
+
+        self.logs = logs
+        return self
+
+    def touch(self, location):
+        """Record that a location was just viewed.  The view times are
+        written at most every SAVE_INTERVAL seconds, and when the CLI exits.
+
+        Arguments:
+            location {LogLocation} -- The location.
+
+        Returns:
+            ExtractionCache -- self
+        """
+
+        if self.budget is None:
+            return self
+
+        with self.__lock:
+            self.__viewed[location.folder] = time.time()
+            due = time.monotonic() - self.__saved > SAVE_INTERVAL
+        if due:
+            self.save()
+        return self
+
+    def last_viewed(self, location):
+        """Get the time a location was last viewed.
+
+        Arguments:
+            location {LogLocation} -- The location.
+
+        Returns:
+            float -- The timestamp, 0 if it was never viewed.
+        """
+
+        with self.__lock:
+            return self.__viewed.get(location.folder, 0)
+
+    def size(self, location):
+        """Get the disk space used by the extracted files of a location.
+        The sizes are cached until the folder changes.
+
+        Arguments:
+            location {LogLocation} -- The location.
+
+        Returns:
+            int -- The size in bytes.
+        """
+
+        try:
+            mtime = os.stat(location.folder).st_mtime_ns
+        except OSError:
+            return 0
+
+        cached = self.__sizes.get(location.folder)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        size = 0
+        for root, _, files in os.walk(location.folder):
+            for name in files:
+                try:
+                    size += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        self.__sizes[location.folder] = (mtime, size)
+        return size
+
+    def enforce(self):
+        """Evict the least recently viewed locations until the extracted
+        files fit in the budget.  Locations with a running or starting
+        oscilloscope and locations without an archive are never evicted.
+
+        Returns:
+            int -- The number of bytes freed.
+        """
+
+        if self.budget is None:
+            return 0
+
+        with self.__lock:
+            locations = [location for log in list(self.logs.values())
+                         for location in log.locations.values()]
+            viewed = dict(self.__viewed)
+
+        # Only one thread evicts at a time, the sizes are re-read each time.
+        with self.__evict_lock:
+            sizes = {location.folder: self.size(location)
+                     for location in locations}
+            used = sum(sizes.values())
+            if used <= self.budget:
+                return 0
+
+            freed = 0
+            candidates = sorted(
+                (x for x in locations
+                 if sizes[x.folder] and x.log.archive is not None
+                 and os.path.exists(x.log.archive)),
+                key=lambda x: viewed.get(x.folder, 0))
+            for location in candidates:
+                if used - freed <= self.budget:
+                    break
+                evicted = location.evict()
+                if evicted and settings.settings.verbose_level > 1:
+                    print('Evicted {}.{} ({:.1f} MiB).'.format(
+                        location.log.node_name, location.id,
+                        evicted / 1024 / 1024))
+                freed += evicted
+
+        if settings.settings.verbose_level > 0 and freed:
+            print('Freed {:.1f} MiB of extracted files.'.format(
+                freed / 1024 / 1024))
+        return freed
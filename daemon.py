@@ -0,0 +1,263 @@
+import concurrent.futures
+import contextvars
+import io
+import os
+import signal
+import socket
+import socketserver
+import sys
+from cmd import Cmd
+from threading import Thread, Event, Lock
+import supervisor
+
+SOCKET_FILE = '.untar.sock'
+SHUTDOWN = 'shutdown'
+
+def supported():
+    """Check if the platform has Unix domain sockets.
+
+    Returns:
+        bool -- True if a daemon can be served, False otherwise.
+    """
+
+    return hasattr(socket, 'AF_UNIX') \
+        and hasattr(socketserver, 'ThreadingUnixStreamServer')
+
+class _ThreadOutput(io.TextIOBase):
+    """Standard output which can be redirected for the current context only,
+    so the output of a command, including the coroutines it submits to the
+    supervisor loop, goes to the client which sent it.  Once the client's
+    stream is closed, the output goes to the daemon's own stream."""
+
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+        self.__buffer = contextvars.ContextVar('buffer', default=None)
+
+    @property
+    def buffer_stream(self):
+        target = self.__buffer.get()
+        if target is None or target.closed:
+            return None
+        return target
+
+    @buffer_stream.setter
+    def buffer_stream(self, value):
+        self.__buffer.set(value)
+
+    def write(self, s):
+        target = self.buffer_stream
+        if target is None:
+            target = self.stream
+        return target.write(s)
+
+    def flush(self):
+        if self.buffer_stream is None:
+            self.stream.flush()
+
+class _CommandHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # Clients checking that the daemon is up connect without a command.
+        line = self.rfile.readline().decode('utf-8', 'replace').strip()
+        if not line:
+            return
+        output = io.StringIO()
+        self.server.control.run(line, output)
+        data = output.getvalue()
+        # Processes outliving the command report to the daemon's output.
+        output.close()
+        try:
+            self.wfile.write(data.encode('utf-8'))
+        except OSError:
+            pass
+
+class ControlServer(object):
+    """Own the nodes, extractions and oscilloscope processes of a workspace
+    and run the commands sent by the CLI sessions over a Unix domain socket,
+    so every session shares the same oscilloscopes."""
+
+    def __init__(self, app, path=SOCKET_FILE):
+        """ControlServer constructor.
+
+        Arguments:
+            app {App} -- The application running the commands.
+
+        Keyword Arguments:
+            path {str} -- The socket path. (default: {SOCKET_FILE})
+        """
+
+        super().__init__()
+        self.app = app
+        self.path = path
+        self.__server = None
+        self.__stopped = Event()
+        self.__lock = Lock()
+
+    def run(self, line, output):
+        """Run a command line, writing its output to the given stream.  The
+        oscilloscope starts and stops it queues are waited for, so their
+        output is part of it.
+
+        Arguments:
+            line {str} -- The command line.
+            output {file} -- The stream receiving the output.
+        """
+
+        sys.stdout.buffer_stream = output
+        futures = []
+        token = supervisor.submitted.set(futures)
+        try:
+            if line == SHUTDOWN:
+                print('Daemon stopping.')
+                self.__stopped.set()
+                return
+
+            # Exiting only ends the client session.
+            cmd, _, _ = self.app.parseline(line)
+            if cmd == 'exit':
+                return
+
+            # Commands share the node registry, so they run one at a time.
+            with self.__lock:
+                self.app.onecmd(line)
+            concurrent.futures.wait(futures)
+        except Exception as e:
+            print('Command failed: {}'.format(e))
+        finally:
+            supervisor.submitted.reset(token)
+            sys.stdout.buffer_stream = None
+
+    def serve(self):
+        """Prepare the nodes, then serve the commands until the shutdown
+        command or a termination signal.
+
+        Raises:
+            Exception: Another daemon already serves this workspace.
+
+        Returns:
+            ControlServer -- self
+        """
+
+        if DaemonClient.connect(self.path) is not None:
+            raise Exception('A daemon is already running on {}.'.format(
+                self.path))
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        if not isinstance(sys.stdout, _ThreadOutput):
+            sys.stdout = _ThreadOutput(sys.stdout)
+        self.app.stdout = sys.stdout
+
+        self.app.preloop()
+        self.__server = socketserver.ThreadingUnixStreamServer(
+            self.path, _CommandHandler)
+        self.__server.daemon_threads = True
+        self.__server.control = self
+        # Every engineer of the group may connect, no one else.
+        os.chmod(self.path, 0o660)
+
+        Thread(target=self.__server.serve_forever, daemon=True).start()
+        signal.signal(signal.SIGTERM, lambda *args: self.__stopped.set())
+        print('Daemon listening on {}.'.format(self.path))
+
+        try:
+            while not self.__stopped.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.__server.shutdown()
+            self.__server.server_close()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.app.postloop()
+
+        return self
+
+class DaemonClient(Cmd):
+    """Thin CLI sending every command to the daemon of the workspace."""
+
+    prompt = '> '
+
+    def __init__(self, path=SOCKET_FILE):
+        """DaemonClient constructor.
+
+        Keyword Arguments:
+            path {str} -- The socket path. (default: {SOCKET_FILE})
+        """
+
+        super().__init__()
+        self.path = path
+        self.intro = 'CLI connected to the daemon on {}'.format(path)
+
+    @classmethod
+    def connect(cls, path=SOCKET_FILE):
+        """Get a client for the daemon listening on the socket, if any.
+
+        Keyword Arguments:
+            path {str} -- The socket path. (default: {SOCKET_FILE})
+
+        Returns:
+            {None, DaemonClient} -- The client, or None if no daemon is
+                                    listening or Unix sockets aren't
+                                    supported.
+        """
+
+        if not supported() or not os.path.exists(path):
+            return None
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(path)
+        except OSError:
+            return None
+        finally:
+            s.close()
+        return cls(path)
+
+    def send(self, line):
+        """Run a command line on the daemon.
+
+        Arguments:
+            line {str} -- The command line.
+
+        Returns:
+            str -- The output of the command.
+        """
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(self.path)
+            s.sendall(line.encode('utf-8') + b'\n')
+            s.shutdown(socket.SHUT_WR)
+            chunks = []
+            while True:
+                chunk = s.recv(64 * 1024)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        return b''.join(chunks).decode('utf-8', 'replace')
+
+    def onecmd(self, line):
+        """Send the line to the daemon and print its output.  'exit' only
+        closes this session, 'shutdown' stops the daemon.
+
+        Arguments:
+            line {str} -- The command line.
+
+        Returns:
+            bool -- True to end the session.
+        """
+
+        line = line.strip()
+        if not line:
+            return False
+        if line == 'EOF' or 'exit'.startswith(line.split()[0]):
+            return True
+
+        try:
+            print(self.send(line), end='')
+        except OSError as e:
+            print('Lost the connection to the daemon: {}'.format(e))
+            return True
+        return line == SHUTDOWN
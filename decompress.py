@@ -0,0 +1,588 @@
+import bz2
+import io
+import lzma
+import os
+import queue
+import shutil
+import struct
+import subprocess
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+import settings
+
+# zstandard and lz4 are optional, their command line tools are used
+# otherwise.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+LZ4 = 'lz4'
+XZ = 'xz'
+BZIP2 = 'bzip2'
+TAR = 'tar'
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+LZ4_MAGIC = b'\x04\x22\x4d\x18'
+XZ_MAGIC = b'\xfd7zXZ\x00'
+BZIP2_MAGIC = b'BZh'
+TAR_MAGIC = b'ustar'
+TAR_MAGIC_OFFSET = 257
+
+# Seekable zstd archives end with a skippable frame holding the sizes of
+# their frames.
+SKIPPABLE_MAGIC = 0x184D2A50
+SKIPPABLE_MASK = 0xFFFFFFF0
+SEEK_TABLE_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+SEEK_TABLE_FOOTER = struct.Struct('<IBI')
+
+EXTERNAL_TOOLS = {
+    GZIP: (('pigz', ['-d', '-c'], '-p'), ('igzip', ['-d', '-c'], '-T')),
+    ZSTD: (('zstd', ['-d', '-c', '-q'], None),),
+    LZ4: (('lz4', ['-d', '-c', '-q'], None),),
+}
+CHUNK_SIZE = 1024 * 1024
+QUEUE_DEPTH = 16
+
+def detect_format(path):
+    """Detect the compression of an archive from its magic bytes.
+
+    Arguments:
+        path {str} -- The path of the archive.
+
+    Returns:
+        str -- GZIP, ZSTD, LZ4, XZ, BZIP2, or TAR for anything else.
+    """
+
+    with open(path, 'rb') as f:
+        header = f.read(TAR_MAGIC_OFFSET + len(TAR_MAGIC))
+
+    if header.startswith(GZIP_MAGIC):
+        return GZIP
+    if header.startswith(ZSTD_MAGIC):
+        return ZSTD
+    if len(header) >= 4 and struct.unpack('<I', header[:4])[0] \
+            & SKIPPABLE_MASK == SKIPPABLE_MAGIC:
+        return ZSTD
+    if header.startswith(LZ4_MAGIC):
+        return LZ4
+    if header.startswith(XZ_MAGIC):
+        return XZ
+    if header.startswith(BZIP2_MAGIC):
+        return BZIP2
+    return TAR
+
+def read_seek_table(path):
+    """Read the seek table of a seekable zstd archive.
+
+    Arguments:
+        path {str} -- The path of the archive.
+
+    Returns:
+        {None, list} -- List of (compressed offset, uncompressed offset,
+                        compressed size, uncompressed size) tuples, one per
+                        frame, or None if the archive has no seek table.
+    """
+
+    size = os.path.getsize(path)
+    if size < SEEK_TABLE_FOOTER.size + 8:
+        return None
+
+    with open(path, 'rb') as f:
+        f.seek(size - SEEK_TABLE_FOOTER.size)
+        count, descriptor, magic = SEEK_TABLE_FOOTER.unpack(
+            f.read(SEEK_TABLE_FOOTER.size))
+        if magic != SEEKABLE_MAGIC:
+            return None
+
+        # Each entry may be followed by a checksum.
+        entry_size = 12 if descriptor & 0x80 else 8
+        table_size = count * entry_size + SEEK_TABLE_FOOTER.size
+        if size < table_size + 8:
+            return None
+        f.seek(size - table_size - 8)
+        magic, frame_size = struct.unpack('<II', f.read(8))
+        if magic != SEEK_TABLE_MAGIC or frame_size != table_size:
+            return None
+        entries = f.read(count * entry_size)
+
+    frames = []
+    compressed = uncompressed = 0
+    for i in range(count):
+        csize, usize = struct.unpack_from('<II', entries, i * entry_size)
+        frames.append((compressed, uncompressed, csize, usize))
+        compressed += csize
+        uncompressed += usize
+    return frames
+
+def open_zstd(fileobj, threads=1):
+    """Decompress a zstd stream from the current position of a file,
+    with the zstandard module or else the zstd tool.
+
+    Arguments:
+        fileobj {file} -- The compressed file, closed with the stream.
+
+    Keyword Arguments:
+        threads {int} -- Number of threads the tool may use.
+                         (default: {1})
+
+    Raises:
+        Exception: Neither the module nor the tool is available.
+
+    Returns:
+        file -- A readable binary file object which must be closed.
+    """
+
+    if zstandard is not None:
+        try:
+            return zstandard.ZstdDecompressor().stream_reader(
+                fileobj, read_size=CHUNK_SIZE, read_across_frames=True,
+                closefd=True)
+        except TypeError:
+            # Versions which stop at the first frame are of no use.
+            pass
+
+    stream = ExternalReader.open(None, threads, ZSTD, stdin=fileobj)
+    if stream is None:
+        fileobj.close()
+        raise Exception('zstd archives need the zstandard module or the '
+                        'zstd tool.')
+    return stream
+
+def open_archive(path, threads=None):
+    """Open the archive as a stream of uncompressed tar data, decompressing
+    on as many cores as the archive allows.
+
+    The format is detected from the magic bytes.  For gzip, a system
+    pigz/igzip binary is preferred when present.  Otherwise, blocked gzip
+    archives (BGZF-style, each member stating its own size) are inflated in
+    parallel and any other gzip stream is inflated on a background thread
+    so the decompression is pipelined with the tar parsing.  The frames of
+    seekable zstd archives are decompressed in parallel when the zstandard
+    module is present.  zstd and lz4 fall back to their command line tools,
+    xz and bzip2 use the standard library and plain tar archives are
+    returned as a plain file.
+
+    Arguments:
+        path {str} -- The path of the archive.
+
+    Keyword Arguments:
+        threads {int} -- Number of decompression threads.  If None, the
+                         settings value or the number of CPUs is used.
+                         (default: {None})
+
+    Returns:
+        file -- A readable binary file object which must be closed.
+    """
+
+    if threads is None:
+        threads = settings.settings.decompress_threads or os.cpu_count() or 1
+
+    archive_format = detect_format(path)
+    if archive_format == ZSTD:
+        frames = read_seek_table(path)
+        if zstandard is not None and frames is not None and threads > 1:
+            return FramedZstdReader(path, frames, threads)
+        return open_zstd(open(path, 'rb'), threads)
+    if archive_format == LZ4:
+        if lz4 is not None:
+            return lz4.frame.open(path, 'rb')
+        stream = ExternalReader.open(path, threads, LZ4)
+        if stream is None:
+            raise Exception('lz4 archives need the lz4 module or the lz4 '
+                            'tool.')
+        return stream
+    if archive_format == XZ:
+        return lzma.open(path, 'rb')
+    if archive_format == BZIP2:
+        return bz2.open(path, 'rb')
+    if archive_format != GZIP:
+        return open(path, 'rb', buffering=CHUNK_SIZE)
+
+    if settings.settings.external_gzip:
+        stream = ExternalReader.open(path, threads)
+        if stream is not None:
+            return stream
+
+    blocks = BlockedGzipReader.find_blocks(path)
+    if blocks is not None and threads > 1:
+        return BlockedGzipReader(path, blocks, threads)
+
+    return PipelinedGzipReader(path)
+
+def inflate_members(data):
+    """Inflate a buffer containing one or more complete gzip members.
+
+    Arguments:
+        data {bytes} -- The compressed data.
+
+    Returns:
+        bytes -- The uncompressed data.
+    """
+
+    out = []
+    while data:
+        d = zlib.decompressobj(wbits=31)
+        out.append(d.decompress(data))
+        if not d.eof:
+            raise zlib.error('Truncated gzip member.')
+        data = d.unused_data
+    return b''.join(out)
+
+class _ChunkReader(io.RawIOBase):
+    """Read-only stream served from a sequence of decompressed chunks."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunk = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def _next_chunk(self):
+        """Get the next decompressed chunk, or b'' at the end of the
+        stream."""
+
+        raise NotImplementedError
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self.readall()
+
+        while not self._chunk:
+            chunk = self._next_chunk()
+            if not chunk:
+                return b''
+            self._chunk = memoryview(chunk)
+
+        data = self._chunk[:size].tobytes()
+        self._chunk = self._chunk[size:]
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+class ExternalReader(_ChunkReader):
+    """Decompress by piping the archive through a command line tool: pigz
+    or igzip for gzip, zstd or lz4."""
+
+    def __init__(self, proc, tool, stdin=None):
+        super().__init__()
+        self.proc = proc
+        self.tool = tool
+        self.stdin = stdin
+
+    @classmethod
+    def open(cls, path, threads, archive_format=GZIP, stdin=None):
+        """Start the first available external decompressor.
+
+        Arguments:
+            path {str} -- The path of the archive, None to read stdin.
+            threads {int} -- Number of threads the tool may use.
+
+        Keyword Arguments:
+            archive_format {str} -- The compression format.
+                                    (default: {GZIP})
+            stdin {file} -- File fed to the tool from its current position
+                            instead of the path, closed with the reader.
+                            (default: {None})
+
+        Returns:
+            {None, ExternalReader} -- The reader or None if no tool could be
+                                      started.
+        """
+
+        for tool, args, threads_flag in EXTERNAL_TOOLS[archive_format]:
+            exe = shutil.which(tool)
+            if exe is None:
+                continue
+            cmd = [exe] + args
+            if threads_flag is not None:
+                cmd += [threads_flag, str(threads)]
+            if path is not None:
+                cmd.append(path)
+            try:
+                proc = subprocess.Popen(cmd, stdin=stdin,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        bufsize=CHUNK_SIZE)
+            except OSError:
+                continue
+            if settings.settings.verbose_level > 1:
+                print('Decompressing {} with {}.'.format(path or 'stream',
+                                                        tool))
+            return cls(proc, tool, stdin)
+
+        return None
+
+    def _next_chunk(self):
+        return self.proc.stdout.read(CHUNK_SIZE)
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+
+        if self.stdin is not None:
+            self.stdin.close()
+
+        # Stop the tool if the stream wasn't fully consumed.
+        if self.proc.poll() is None:
+            self.proc.stdout.close()
+            self.proc.kill()
+            self.proc.wait()
+            return
+
+        self.proc.stdout.close()
+        err = self.proc.stderr.read()
+        self.proc.stderr.close()
+        if self.proc.wait() != 0:
+            raise Exception('{} failed: {}'.format(
+                self.tool, err.decode(errors='replace').strip()))
+
+class BlockedGzipReader(_ChunkReader):
+    """Inflate a blocked gzip archive on a thread pool, in order."""
+
+    BATCH_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, path, blocks, threads):
+        super().__init__()
+        self.file = open(path, 'rb')
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.pending = deque()
+        self.batches = self.__batches(blocks)
+        self.depth = threads * 2
+
+    @staticmethod
+    def find_blocks(path):
+        """Find the member boundaries of a blocked gzip archive by walking
+        the member headers, without inflating anything.
+
+        Arguments:
+            path {str} -- The path of the archive.
+
+        Returns:
+            {None, list} -- List of (offset, size) tuples or None if any of
+                            the members doesn't state its size.
+        """
+
+        blocks = []
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            offset = 0
+            while offset < size:
+                f.seek(offset)
+                header = f.read(12)
+                if len(header) < 12 or header[:2] != GZIP_MAGIC \
+                        or not header[3] & 4:
+                    return None
+                xlen = struct.unpack('<H', header[10:12])[0]
+                extra = f.read(xlen)
+
+                # Look for the 'BC' subfield holding the block size - 1.
+                bsize = None
+                i = 0
+                while i + 4 <= len(extra):
+                    slen = struct.unpack('<H', extra[i + 2:i + 4])[0]
+                    if extra[i:i + 2] == b'BC' and slen == 2:
+                        bsize = struct.unpack('<H',
+                                              extra[i + 4:i + 6])[0] + 1
+                    i += 4 + slen
+                if bsize is None:
+                    return None
+
+                blocks.append((offset, bsize))
+                offset += bsize
+
+        return blocks if len(blocks) > 1 else None
+
+    def __batches(self, blocks):
+        # Group consecutive blocks so each task is large enough to amortize
+        # the scheduling cost.
+        start, size = None, 0
+        for offset, bsize in blocks:
+            if start is None:
+                start = offset
+            size += bsize
+            if size >= self.BATCH_SIZE:
+                yield start, size
+                start, size = None, 0
+        if start is not None:
+            yield start, size
+
+    def _next_chunk(self):
+        while len(self.pending) < self.depth:
+            batch = next(self.batches, None)
+            if batch is None:
+                break
+            self.file.seek(batch[0])
+            self.pending.append(self.executor.submit(inflate_members,
+                                                     self.file.read(batch[1])))
+
+        if not self.pending:
+            return b''
+        return self.pending.popleft().result()
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        for future in self.pending:
+            future.cancel()
+        self.executor.shutdown()
+        self.file.close()
+
+class FramedZstdReader(_ChunkReader):
+    """Decompress the frames of a seekable zstd archive on a thread pool,
+    in order."""
+
+    BATCH_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, path, frames, threads):
+        super().__init__()
+        self.file = open(path, 'rb')
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.pending = deque()
+        self.batches = self.__batches(frames)
+        self.depth = threads * 2
+
+    @staticmethod
+    def decompress_frames(data, sizes):
+        """Decompress consecutive complete frames.
+
+        Arguments:
+            data {bytes} -- The compressed frames.
+            sizes {list} -- The (compressed, uncompressed) size of each one.
+
+        Returns:
+            bytes -- The uncompressed data.
+        """
+
+        d = zstandard.ZstdDecompressor()
+        out = []
+        offset = 0
+        for csize, usize in sizes:
+            out.append(d.decompress(data[offset:offset + csize],
+                                    max_output_size=usize))
+            offset += csize
+        return b''.join(out)
+
+    def __batches(self, frames):
+        start, size, sizes = None, 0, []
+        for offset, _, csize, usize in frames:
+            if start is None:
+                start = offset
+            size += csize
+            sizes.append((csize, usize))
+            if size >= self.BATCH_SIZE:
+                yield start, size, sizes
+                start, size, sizes = None, 0, []
+        if start is not None:
+            yield start, size, sizes
+
+    def _next_chunk(self):
+        while len(self.pending) < self.depth:
+            batch = next(self.batches, None)
+            if batch is None:
+                break
+            self.file.seek(batch[0])
+            self.pending.append(self.executor.submit(
+                self.decompress_frames, self.file.read(batch[1]), batch[2]))
+
+        if not self.pending:
+            return b''
+        return self.pending.popleft().result()
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        for future in self.pending:
+            future.cancel()
+        self.executor.shutdown()
+        self.file.close()
+
+class PipelinedGzipReader(_ChunkReader):
+    """Inflate a gzip archive on a background thread, so decompression
+    overlaps with the tar parsing and the file writes."""
+
+    def __init__(self, path):
+        super().__init__()
+        self.queue = queue.Queue(maxsize=QUEUE_DEPTH)
+        self.stopped = False
+        self.eof = False
+        self.thread = Thread(target=self.__inflate, args=(path,), daemon=True)
+        self.thread.start()
+
+    def __inflate(self, path):
+        try:
+            with open(path, 'rb') as f:
+                d = zlib.decompressobj(wbits=31)
+                data = b''
+                while not self.stopped:
+                    if not data:
+                        data = f.read(CHUNK_SIZE)
+                        if not data:
+                            if not d.eof:
+                                raise zlib.error('Truncated gzip archive.')
+                            break
+
+                    # Bound the output of each step so highly compressible
+                    # data doesn't inflate into a huge chunk.
+                    chunk = d.decompress(data, CHUNK_SIZE)
+                    if chunk:
+                        self.queue.put(chunk)
+                    data = d.unconsumed_tail
+                    if not d.eof:
+                        continue
+
+                    # Concatenated members are allowed and trailing zero
+                    # padding is ignored, like gzip does.
+                    data = d.unused_data.lstrip(b'\x00')
+                    while not data:
+                        data = f.read(CHUNK_SIZE)
+                        if not data:
+                            break
+                        data = data.lstrip(b'\x00')
+                    if not data:
+                        break
+                    d = zlib.decompressobj(wbits=31)
+            self.queue.put(None)
+        except Exception as e:
+            self.queue.put(e)
+
+    def _next_chunk(self):
+        if self.eof:
+            return b''
+        chunk = self.queue.get()
+        if isinstance(chunk, Exception):
+            raise chunk
+        if chunk is None:
+            self.eof = True
+            return b''
+        return chunk
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+
+        # Unblock the inflating thread if it's waiting on a full queue.
+        self.stopped = True
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
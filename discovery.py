@@ -0,0 +1,180 @@
+import json
+import os
+import re
+from threading import Lock
+import settings
+
+SNAPSHOT_FILE = '.untar_snapshot.json'
+
+class Workspace(object):
+    """Discover the node archives, node folders and their locations with as
+    few directory reads as possible.  What was found is kept in a snapshot
+    which stays valid as long as the directory modification times don't
+    change."""
+
+    __instance = None
+    __instance_lock = Lock()
+
+    def __init__(self, path='.'):
+        """Workspace constructor.
+
+        Keyword Arguments:
+            path {str} -- The workspace directory. (default: {'.'})
+        """
+
+        if Workspace.__instance is not None:
+            raise Exception('This class is a singleton!')
+
+        super().__init__()
+        self.path = path
+        self.archives = {}
+        self.folders = {}
+        self.__snapshot = {'mtime': None, 'archives': {}, 'folders': {},
+                           'locations': {}}
+        self.__dirty = False
+        self.__lock = Lock()
+        self.__load()
+        Workspace.__instance = self
+
+    @classmethod
+    def get_instance(cls):
+        """Get the Workspace instance.
+
+        Returns:
+            Workspace -- the Workspace instance
+        """
+
+        with cls.__instance_lock:
+            if cls.__instance is None:
+                cls()
+        return cls.__instance
+
+    @staticmethod
+    def entry_regex(archive_regex):
+        """Build a single regex matching both the node archives and the node
+        folders.  The node name is in the 'archive' group for archives and in
+        the 'folder' group for folders.
+
+        Arguments:
+            archive_regex {re.Pattern} -- The archive pattern, with the node
+                                          name as its only group.
+
+        Returns:
+            re.Pattern -- The combined regex.
+        """
+
+        archive = archive_regex.pattern.replace('(', '(?P<archive>', 1)
+        folder = settings.settings.folder_format % r'(?P<folder>.*)'
+        return re.compile(r'(?:{})|(?:{}$)'.format(archive, folder))
+
+    def __load(self):
+        try:
+            with open(os.path.join(self.path, SNAPSHOT_FILE)) as f:
+                snapshot = json.load(f)
+            if snapshot.get('folder_format') == settings.settings.folder_format:
+                self.__snapshot.update(snapshot)
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    def save(self):
+        """Write the snapshot if anything changed since it was loaded.
+
+        Returns:
+            Workspace -- self
+        """
+
+        with self.__lock:
+            if not self.__dirty:
+                return self
+            self.__dirty = False
+            self.__snapshot['folder_format'] = settings.settings.folder_format
+
+            # Creating the snapshot file changes the workspace mtime, so the
+            # new mtime is recorded and the file rewritten in place, which
+            # doesn't change it again.
+            path = os.path.join(self.path, SNAPSHOT_FILE)
+            try:
+                before = os.stat(self.path).st_mtime_ns
+                with open(path, 'w') as f:
+                    json.dump(self.__snapshot, f)
+                after = os.stat(self.path).st_mtime_ns
+                if after != before and self.__snapshot['mtime'] == before:
+                    self.__snapshot['mtime'] = after
+                    with open(path, 'w') as f:
+                        json.dump(self.__snapshot, f)
+            except OSError:
+                pass
+
+        return self
+
+    def scan(self, archive_regex):
+        """Find the node archives and folders in a single pass over the
+        workspace, unless it didn't change since the snapshot.
+
+        Arguments:
+            archive_regex {re.Pattern} -- The archive pattern, with the node
+                                          name as its only group.
+
+        Returns:
+            Workspace -- self
+        """
+
+        mtime = os.stat(self.path).st_mtime_ns
+        with self.__lock:
+            if mtime != self.__snapshot['mtime'] \
+                    or archive_regex.pattern \
+                    != self.__snapshot.get('archive_pattern'):
+                archives, folders = {}, {}
+                p = self.entry_regex(archive_regex)
+                with os.scandir(self.path) as it:
+                    for entry in it:
+                        match = p.match(entry.name)
+                        if match is None:
+                            continue
+                        if match.group('archive') is not None:
+                            if entry.is_file():
+                                archives[entry.name] = match.group('archive')
+                        elif entry.is_dir():
+                            folders[entry.name] = match.group('folder')
+                locations = {k: v for k, v
+                             in self.__snapshot['locations'].items()
+                             if os.path.basename(k) in folders}
+                self.__snapshot.update(mtime=mtime, archives=archives,
+                                       folders=folders, locations=locations,
+                                       archive_pattern=archive_regex.pattern)
+                self.__dirty = True
+
+            self.archives = dict(self.__snapshot['archives'])
+            self.folders = dict(self.__snapshot['folders'])
+
+        return self
+
+    def location_folders(self, folder, location_regex):
+        """Get the location folders directly under a node folder.
+
+        Arguments:
+            folder {str} -- The node folder.
+            location_regex {re.Pattern} -- The location folder pattern.
+
+        Returns:
+            list -- The names of the location folders.
+        """
+
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+        except OSError:
+            return []
+
+        with self.__lock:
+            cached = self.__snapshot['locations'].get(folder)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        with os.scandir(folder) as it:
+            locations = [entry.name for entry in it
+                         if location_regex.match(entry.name)
+                         and entry.is_dir()]
+        with self.__lock:
+            self.__snapshot['locations'][folder] = [mtime, locations]
+            self.__dirty = True
+        return locations
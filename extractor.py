@@ -0,0 +1,571 @@
+import errno
+import mmap
+import os
+import queue
+import sys
+import tarfile
+import time
+from threading import Thread, Lock
+from decompress import TAR, detect_format
+
+DEFAULT_BUFFER_SIZE = 4 * 1024 * 1024
+WRITE_BUFFERS = 4
+# Seconds between two reports of the extraction progress.
+CHECKPOINT_INTERVAL = 2
+ALIGNMENT = mmap.PAGESIZE
+# Smaller files aren't worth the extra system call.
+PREALLOCATE_MIN = 1024 * 1024
+OPEN_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+# Errors meaning the kernel can't copy between these two files.
+NO_KERNEL_COPY = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                  errno.EBADF, errno.ENOTSUP)
+
+def aligned_buffer(size):
+    """Allocate a page aligned buffer of whole pages, so the writes from it
+    start on page boundaries.
+
+    Arguments:
+        size {int} -- The minimum size in bytes.
+
+    Returns:
+        mmap.mmap -- The anonymous mapping used as buffer.
+    """
+
+    size = max(1, -(-size // ALIGNMENT)) * ALIGNMENT
+    return mmap.mmap(-1, size)
+
+def preallocate(fd, size):
+    """Reserve the space of a file before it's written, so it's laid out
+    in as few extents as possible.  Failures are ignored.
+
+    Arguments:
+        fd {int} -- The file descriptor.
+        size {int} -- The final size of the file.
+    """
+
+    if size < PREALLOCATE_MIN or not hasattr(os, 'posix_fallocate'):
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError:
+        pass
+
+def write_all(fd, data):
+    """Write all the data to a file descriptor.
+
+    Arguments:
+        fd {int} -- The file descriptor.
+        data {bytes-like} -- The data.
+    """
+
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+def copy_range(src, fd, offset, size, buffer):
+    """Copy a range of a file to a file descriptor, in the kernel with
+    copy_file_range or sendfile where possible, else through the buffer.
+
+    Arguments:
+        src {file} -- The source file, opened in binary mode.
+        fd {int} -- The destination file descriptor.
+        offset {int} -- Start of the range in the source.
+        size {int} -- Size of the range.
+        buffer {bytes-like} -- Buffer used when the kernel can't copy.
+
+    Raises:
+        EOFError: The source ends before the range.
+    """
+
+    end = offset + size
+    src_fd = src.fileno()
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < end:
+                n = os.copy_file_range(src_fd, fd, end - offset, offset)
+                if not n:
+                    raise EOFError('Unexpected end of archive.')
+                offset += n
+            return
+        except OSError as e:
+            if e.errno not in NO_KERNEL_COPY:
+                raise
+
+    # Only Linux can sendfile into a regular file.
+    if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+        try:
+            while offset < end:
+                n = os.sendfile(fd, src_fd, offset, end - offset)
+                if not n:
+                    raise EOFError('Unexpected end of archive.')
+                offset += n
+            return
+        except OSError as e:
+            if e.errno not in NO_KERNEL_COPY:
+                raise
+
+    view = memoryview(buffer)
+    src.seek(offset)
+    while offset < end:
+        n = src.readinto(view[:min(len(view), end - offset)])
+        if not n:
+            raise EOFError('Unexpected end of archive.')
+        write_all(fd, view[:n])
+        offset += n
+
+class OutputFiles(object):
+    """Create the extracted files relative to a descriptor of their folder,
+    so the members of a folder, which follow each other in the archives,
+    don't resolve its path again for every file."""
+
+    def __init__(self):
+        super().__init__()
+        self.__folder = None
+        self.__folder_fd = None
+
+    def open(self, path, size=0):
+        """Create a file for writing, preallocated to its size.  An existing
+        file is unlinked first, as it may share its content with other
+        files through the store.
+
+        Arguments:
+            path {str} -- The file path.
+
+        Keyword Arguments:
+            size {int} -- The final size of the file. (default: {0})
+
+        Returns:
+            int -- The file descriptor, which must be closed.
+        """
+
+        if os.open not in os.supports_dir_fd:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            fd = os.open(path, OPEN_FLAGS, 0o666)
+        else:
+            folder, name = os.path.split(path)
+            if folder != self.__folder:
+                self.close()
+                self.__folder_fd = os.open(
+                    folder or '.', os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+                self.__folder = folder
+            try:
+                os.unlink(name, dir_fd=self.__folder_fd)
+            except FileNotFoundError:
+                pass
+            fd = os.open(name, OPEN_FLAGS, 0o666, dir_fd=self.__folder_fd)
+        preallocate(fd, size)
+        return fd
+
+    def close(self):
+        """Close the folder descriptor."""
+
+        if self.__folder_fd is not None:
+            os.close(self.__folder_fd)
+        self.__folder = None
+        self.__folder_fd = None
+
+class WriterThread(Thread):
+    """Write member contents on a separate thread, recycling a fixed set of
+    buffers so the memory used stays bounded."""
+
+    def __init__(self, buffer_size, buffers=WRITE_BUFFERS, store=None,
+                 on_done=None):
+        super().__init__(daemon=True)
+        self.ops = queue.Queue()
+        self.free = queue.Queue()
+        for _ in range(buffers):
+            self.free.put(aligned_buffer(buffer_size))
+        self.store = store
+        self.on_done = on_done
+        self.error = None
+        self.write_time = 0.0
+        self.digests = {}
+        self.deduplicated = 0
+
+    def done(self, entry, position):
+        """Queue a call to on_done once everything queued so far is written.
+
+        Arguments:
+            entry {None, tuple} -- The (name, size) of the member written
+                                   last, or None if it was skipped.
+            position {int} -- Offset of the next member header.
+        """
+
+        self.ops.put(('done', entry, position))
+
+    def write_member(self, src, path, size=0):
+        """Queue the member's content to be written at the given path.
+
+        Arguments:
+            src {file} -- The member file object.
+            path {str} -- The destination path.
+
+        Keyword Arguments:
+            size {int} -- The member size. (default: {0})
+        """
+
+        if self.error is not None:
+            raise self.error
+
+        self.ops.put(('open', path, size, None if self.store is None
+                                          else self.store.hasher()))
+        while True:
+            buf = self.free.get()
+            n = src.readinto(memoryview(buf))
+            if not n:
+                self.free.put(buf)
+                break
+            self.ops.put(('write', buf, n))
+        self.ops.put(('close',))
+
+    def finish(self):
+        """Wait for the queued writes and raise their error, if any."""
+
+        self.ops.put(('stop',))
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        files = OutputFiles()
+        fd = None
+        hasher = None
+        path = None
+        written = 0
+        while True:
+            op = self.ops.get()
+
+            # After an error keep consuming the operations, so the buffers
+            # are given back and the parsing thread never blocks.
+            started = time.perf_counter()
+            try:
+                if self.error is None:
+                    if op[0] == 'open':
+                        fd = files.open(op[1], op[2])
+                        path, hasher, written = op[1], op[3], 0
+                    elif op[0] == 'write':
+                        data = memoryview(op[1])[:op[2]]
+                        write_all(fd, data)
+                        written += op[2]
+                        if hasher is not None:
+                            hasher.update(data)
+                    elif op[0] == 'close':
+                        os.close(fd)
+                        fd = None
+                        if hasher is not None:
+                            digest = hasher.hexdigest()
+                            self.digests[path] = digest
+                            if self.store.add(path, digest):
+                                self.deduplicated += written
+                    elif op[0] == 'done' and self.on_done is not None:
+                        self.on_done(op[1], op[2])
+            except Exception as e:
+                self.error = e
+            self.write_time += time.perf_counter() - started
+
+            if op[0] == 'write':
+                self.free.put(op[1])
+            elif op[0] == 'stop':
+                break
+
+        if fd is not None:
+            os.close(fd)
+        files.close()
+
+class StreamExtractor(object):
+    def __init__(self, destination, member_filter=None,
+                 buffer_size=DEFAULT_BUFFER_SIZE, threaded_writes=False,
+                 store=None, checkpoint=None):
+        """StreamExtractor constructor.
+
+        Arguments:
+            destination {str} -- The folder in which the members are written.
+
+        Keyword Arguments:
+            member_filter {callable} -- Called with the normalized member name
+                                        and the TarInfo, returns True if the
+                                        member should be extracted.  If None,
+                                        every member is extracted.
+                                        (default: {None})
+            buffer_size {int} -- Size of the reusable copy buffer.
+                                 (default: {DEFAULT_BUFFER_SIZE})
+            threaded_writes {bool} -- Write the files on a separate thread,
+                                      pipelined with the archive parsing.
+                                      (default: {False})
+            store {ContentStore} -- Store in which the files are hashed
+                                    and deduplicated. (default: {None})
+            checkpoint {callable} -- Called every CHECKPOINT_INTERVAL
+                                     seconds, and when the extraction
+                                     stops, with the (name, size) tuples of
+                                     the members written since the last
+                                     call and the archive offset of the
+                                     first member header after them.
+                                     (default: {None})
+        """
+
+        super().__init__()
+        self.destination = destination
+        self.member_filter = member_filter
+        self.buffer_size = buffer_size
+        self.threaded_writes = threaded_writes
+        self.store = store
+        self.checkpoint = checkpoint
+        self.write_time = 0.0
+        self.digests = {}
+        self.deduplicated = 0
+        self.__done = []
+        self.__position = None
+        self.__progress_lock = Lock()
+        self.__last_checkpoint = time.monotonic()
+        self.__buffer = None
+        self.__writer = None
+        self.__files = None
+        self.__created_dirs = set()
+        self.__mtimes = []
+
+    def extract(self, archive, offset=None):
+        """Extract the archive in a single sequential pass.  A path to an
+        uncompressed tar is read with random access instead: the skipped
+        members are never read and the others are copied by the kernel,
+        straight from the archive.
+
+        Arguments:
+            archive {str, file} -- Path of the archive or a readable binary
+                                   file object positioned at its start.
+
+        Keyword Arguments:
+            offset {int} -- If set, the file object holds uncompressed tar
+                            data starting at this offset of the archive, at
+                            a member header, to resume an interrupted
+                            extraction. (default: {None})
+
+        Returns:
+            list -- List of (name, size) tuples for the extracted files.
+        """
+
+        os.makedirs(self.destination, exist_ok=True)
+        self.__created_dirs.add(self.destination)
+
+        # Stream mode ('r|*') never seeks, so the archive is read exactly once
+        # and the compression is detected from the stream itself.
+        copy = False
+        if isinstance(archive, (str, bytes, os.PathLike)):
+            copy = detect_format(archive) == TAR
+            tar = tarfile.open(archive, mode='r:' if copy else 'r|*',
+                               bufsize=self.buffer_size)
+        else:
+            tar = tarfile.open(fileobj=archive,
+                               mode='r|*' if offset is None else 'r|',
+                               bufsize=self.buffer_size)
+        # Deduplication hashes the content, so it has to go through Python.
+        copy = copy and self.store is None
+
+        if self.threaded_writes and not copy:
+            self.__writer = WriterThread(self.buffer_size, store=self.store,
+                                         on_done=self.__member_done)
+            self.__writer.start()
+        elif self.__buffer is None:
+            self.__buffer = aligned_buffer(self.buffer_size)
+        self.__files = OutputFiles()
+
+        extracted = []
+        try:
+            self.__extract_members(tar, extracted, copy, offset or 0)
+        finally:
+            self.__files.close()
+            try:
+                if self.__writer is not None:
+                    writer, self.__writer = self.__writer, None
+                    try:
+                        writer.finish()
+                    finally:
+                        self.write_time += writer.write_time
+                        self.deduplicated += writer.deduplicated
+                        for path, digest in writer.digests.items():
+                            self.digests[self.__relative(path)] = digest
+            finally:
+                # Whatever was written before a failure is kept.
+                self.__report_progress()
+
+        self.__set_mtimes()
+        return extracted
+
+    def __member_done(self, entry, position):
+        with self.__progress_lock:
+            if entry is not None:
+                self.__done.append(entry)
+            self.__position = position
+
+    def __report_progress(self):
+        if self.checkpoint is None:
+            return
+        with self.__progress_lock:
+            done, self.__done = self.__done, []
+            position = self.__position
+        self.__last_checkpoint = time.monotonic()
+        if done or position is not None:
+            self.checkpoint(done, position)
+
+    def __relative(self, path):
+        return os.path.relpath(path, self.destination).replace(os.sep, '/')
+
+    def __set_mtimes(self):
+        # The modification times are set once every file is written, so the
+        # metadata updates don't interleave with the data writes.
+        started = time.perf_counter()
+        mtimes, self.__mtimes = self.__mtimes, []
+        for path, mtime in mtimes:
+            try:
+                os.utime(path, (mtime, mtime))
+            except OSError:
+                pass
+        self.write_time += time.perf_counter() - started
+
+    def __extract_members(self, tar, extracted, copy=False, offset=0):
+        with tar:
+            for member in tar:
+                entry = self.__extract_member(tar, member, copy)
+                if entry is not None:
+                    extracted.append(entry)
+
+                # The next header is where an interrupted extraction resumes.
+                position = offset + tar.offset
+                if self.__writer is not None:
+                    self.__writer.done(entry, position)
+                else:
+                    self.__member_done(entry, position)
+                if self.checkpoint is not None and time.monotonic() \
+                        - self.__last_checkpoint >= CHECKPOINT_INTERVAL:
+                    self.__report_progress()
+
+    def __extract_member(self, tar, member, copy):
+        name = self.normalize_name(member.name)
+        if name is None:
+            return None
+        if self.member_filter is not None \
+                and not self.member_filter(name, member):
+            return None
+
+        path = os.path.join(self.destination, name)
+        if member.isdir():
+            self.__make_dirs(path)
+        elif member.isfile():
+            self.__make_dirs(os.path.dirname(path))
+            if copy:
+                self.__copy_member(tar.fileobj, member, path)
+            elif self.store is not None \
+                    and member.size <= self.buffer_size:
+                self.__write_small_member(tar.extractfile(member),
+                                          path, name, member.size)
+            else:
+                self.write_member(tar.extractfile(member), path,
+                                  member.size)
+            if member.mtime:
+                self.__mtimes.append((path, member.mtime))
+            return (name, member.size)
+        return None
+
+    def __copy_member(self, archive, member, path):
+        started = time.perf_counter()
+        fd = self.__files.open(path, member.size)
+        try:
+            copy_range(archive, fd, member.offset_data, member.size,
+                       self.__buffer)
+        finally:
+            os.close(fd)
+            self.write_time += time.perf_counter() - started
+
+    def __write_small_member(self, src, path, name, size):
+        # Small members are hashed before being written, so the duplicates
+        # are never written at all.
+        data = src.read()
+        hasher = self.store.hasher()
+        hasher.update(data)
+        digest = hasher.hexdigest()
+        self.digests[name] = digest
+
+        started = time.perf_counter()
+        if self.store.link(digest, path):
+            self.deduplicated += len(data)
+        else:
+            fd = self.__files.open(path, size)
+            try:
+                write_all(fd, data)
+            finally:
+                os.close(fd)
+            self.store.add(path, digest)
+        self.write_time += time.perf_counter() - started
+
+    def write_member(self, src, path, size=0):
+        """Copy a member's content to the given path using the reusable
+        buffer.  With a store, the content is hashed as it's written and the
+        file deduplicated once complete.
+
+        Arguments:
+            src {file} -- The member file object.
+            path {str} -- The destination path.
+
+        Keyword Arguments:
+            size {int} -- The member size, preallocated before writing.
+                          (default: {0})
+        """
+
+        if self.__writer is not None:
+            return self.__writer.write_member(src, path, size)
+
+        # Only the file system calls count as write time, the reads are
+        # where the decompression happens.
+        hasher = self.store.hasher() if self.store is not None else None
+        view = memoryview(self.__buffer)
+        written = 0
+        started = time.perf_counter()
+        files = self.__files if self.__files is not None else OutputFiles()
+        fd = files.open(path, size)
+        try:
+            while True:
+                self.write_time += time.perf_counter() - started
+                n = src.readinto(view)
+                if n and hasher is not None:
+                    hasher.update(view[:n])
+                started = time.perf_counter()
+                if not n:
+                    break
+                write_all(fd, view[:n])
+                written += n
+        finally:
+            os.close(fd)
+            if files is not self.__files:
+                files.close()
+            self.write_time += time.perf_counter() - started
+
+        if hasher is not None:
+            digest = hasher.hexdigest()
+            self.digests[self.__relative(path)] = digest
+            if self.store.add(path, digest):
+                self.deduplicated += written
+
+    @staticmethod
+    def normalize_name(name):
+        """Normalize a member name to a relative path inside the destination.
+
+        Arguments:
+            name {str} -- The member name as found in the archive.
+
+        Returns:
+            {None, str} -- The normalized name or None if the member would be
+                           written outside of the destination.
+        """
+
+        name = os.path.normpath(name.replace('\\', '/')).lstrip('/')
+        if name in ('', '.') or name == '..' \
+                or name.startswith('..' + os.sep) or os.path.isabs(name):
+            return None
+        return name
+
+    def __make_dirs(self, path):
+        if path not in self.__created_dirs:
+            os.makedirs(path, exist_ok=True)
+            self.__created_dirs.add(path)
@@ -0,0 +1,54 @@
+import argparse
+import os
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class _Handler(BaseHTTPRequestHandler):
+    traces = []
+
+    def do_GET(self):
+        body = ''.join('<li>{}</li>'.format(os.path.basename(x))
+                       for x in self.traces)
+        body = '<html><body><ul>{}</ul></body></html>'.format(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Stand-in for oscilloscope.exe used by the benchmarks.  Reads the traces, waits for the load delay, then serves a page on the given port.')
+    parser.add_argument("--port", '-p', required=True, type=int, help="Port to listen on")
+    parser.add_argument("--delay", '-d', default=0.5, type=float, help="Seconds spent loading the traces before listening (default: %(default)s)")
+    parser.add_argument("traces", nargs='*', help="Trace files")
+
+    return parser
+
+def main():
+    args = build_parser().parse_args()
+
+    # Read the traces like the real one would, then simulate the parsing.
+    started = time.monotonic()
+    for trace in args.traces:
+        try:
+            with open(trace, 'rb') as f:
+                while f.read(1024 * 1024):
+                    pass
+        except OSError:
+            pass
+    time.sleep(max(args.delay - (time.monotonic() - started), 0))
+
+    _Handler.traces = args.traces
+    server = ThreadingHTTPServer(('localhost', args.port), _Handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,533 @@
+import bisect
+import json
+import os
+import struct
+import tarfile
+import zlib
+from collections import deque
+from threading import Lock
+from decompress import GZIP, TAR, ZSTD, CHUNK_SIZE, _ChunkReader, \
+                       BlockedGzipReader, detect_format, open_archive, \
+                       open_zstd, read_seek_table
+from extractor import StreamExtractor, OutputFiles, aligned_buffer, \
+                      copy_range, write_all
+from manifest import Manifest
+
+RECENT_CHECKPOINTS = 4
+# Uncompressed bytes between two checkpoints taken while extracting.
+CHECKPOINT_SPACING = 8 * 1024 * 1024
+
+def index_path(archive):
+    """Get the path of the side-car index of an archive.  The name starts
+    with a dot so it never matches the archive or folder patterns.
+
+    Arguments:
+        archive {str} -- The path of the archive.
+
+    Returns:
+        str -- The path of the index.
+    """
+
+    folder, name = os.path.split(archive)
+    return os.path.join(folder, '.{}.index'.format(name))
+
+def restart_points(archive, archive_format=None):
+    """Get the points from which the archive can be decompressed without
+    any earlier state: the frame starts of seekable zstd archives and the
+    member starts of blocked gzip archives.  Other compressed archives can
+    only be decompressed from their start.
+
+    Arguments:
+        archive {str} -- The path of the archive.
+
+    Keyword Arguments:
+        archive_format {str} -- The format, detected if None.
+                                (default: {None})
+
+    Returns:
+        {None, list} -- Sorted list of (compressed, uncompressed) offsets,
+                        or None for uncompressed archives, where every
+                        offset is a restart point.
+    """
+
+    if archive_format is None:
+        archive_format = detect_format(archive)
+    if archive_format == TAR:
+        return None
+
+    points = [(0, 0)]
+    if archive_format == ZSTD:
+        points = [x[:2] for x in read_seek_table(archive) or []] or points
+    elif archive_format == GZIP:
+        blocks = BlockedGzipReader.find_blocks(archive)
+        if blocks is not None:
+            # Each member ends with its uncompressed size.
+            points = []
+            uncompressed = 0
+            with open(archive, 'rb') as f:
+                for offset, size in blocks:
+                    points.append((offset, uncompressed))
+                    f.seek(offset + size - 4)
+                    uncompressed += struct.unpack('<I', f.read(4))[0]
+    return points
+
+def open_at(archive, checkpoint, offset, archive_format=None):
+    """Open the uncompressed tar data of the archive at an offset, starting
+    from a restart point preceding it.
+
+    Arguments:
+        archive {str} -- The path of the archive.
+        checkpoint {tuple} -- The (compressed, uncompressed) restart point.
+        offset {int} -- The uncompressed offset.
+
+    Keyword Arguments:
+        archive_format {str} -- The format, detected if None.
+                                (default: {None})
+
+    Returns:
+        file -- A readable file object which must be closed.
+    """
+
+    if archive_format is None:
+        archive_format = detect_format(archive)
+    reader = _RangeReader(archive, archive_format, tuple(checkpoint[:2])
+                          + (None,))
+    try:
+        reader.skip(offset - reader.position)
+    except BaseException:
+        reader.close()
+        raise
+    return reader
+
+class _IndexingReader(_ChunkReader):
+    """Inflate a gzip archive while taking a checkpoint before every chunk,
+    so the tar members found in the chunk can later be reached directly."""
+
+    def __init__(self, path):
+        super().__init__()
+        self.file = open(path, 'rb')
+        self.d = zlib.decompressobj(wbits=31)
+        self.data = b''
+        self.compressed = 0
+        self.uncompressed = 0
+        self.member_starts = [(0, 0)]
+        self.recent = deque(maxlen=RECENT_CHECKPOINTS)
+
+    def _next_chunk(self):
+        while True:
+            if not self.data:
+                self.data = self.file.read(CHUNK_SIZE)
+                if not self.data:
+                    if not self.d.eof:
+                        raise zlib.error('Truncated gzip archive.')
+                    return b''
+
+            if self.d.eof:
+                # A new member starts here and can be inflated without any
+                # state, so this checkpoint survives the session.  Trailing
+                # zero padding is ignored, like gzip does.
+                data = self.data.lstrip(b'\x00')
+                self.compressed += len(self.data) - len(data)
+                self.data = data
+                if not self.data:
+                    continue
+                self.member_starts.append((self.compressed,
+                                           self.uncompressed))
+                self.d = zlib.decompressobj(wbits=31)
+
+            # The decompressor state and the offset of the first byte it
+            # hasn't consumed are enough to resume from here.
+            self.recent.append((self.compressed, self.uncompressed,
+                                self.d.copy()))
+            chunk = self.d.decompress(self.data, CHUNK_SIZE)
+            rest = self.d.unused_data if self.d.eof \
+                   else self.d.unconsumed_tail
+            self.compressed += len(self.data) - len(rest)
+            self.uncompressed += len(chunk)
+            self.data = rest
+
+            if chunk:
+                return chunk
+
+    def checkpoint_before(self, offset):
+        """Get the latest recent checkpoint preceding the given uncompressed
+        offset.
+
+        Arguments:
+            offset {int} -- The uncompressed offset.
+
+        Returns:
+            {None, tuple} -- The (compressed, uncompressed, state) tuple.
+        """
+
+        for checkpoint in reversed(self.recent):
+            if checkpoint[1] <= offset:
+                return checkpoint
+        return None
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            self.file.close()
+
+class _RangeReader(object):
+    """Read the uncompressed archive sequentially, starting at a
+    checkpoint.  Only gzip, plain tar and zstd archives have checkpoints
+    past the start, the other formats are always read from the start.
+    While gzip data is inflated, new checkpoints are reported every
+    CHECKPOINT_SPACING bytes, so later reads can start closer."""
+
+    def __init__(self, path, archive_format, checkpoint, on_checkpoint=None):
+        self.file = open(path, 'rb')
+        self.file.seek(checkpoint[0])
+        self.gzipped = archive_format == GZIP
+        self.position = checkpoint[1]
+        self.compressed = checkpoint[0]
+        self.on_checkpoint = on_checkpoint
+        self.last_checkpoint = checkpoint[1]
+        self.d = None
+        self.stream = None
+        if self.gzipped:
+            state = checkpoint[2]
+            self.d = state.copy() if state is not None \
+                     else zlib.decompressobj(wbits=31)
+        elif archive_format == ZSTD:
+            # Checkpoints of seekable archives are at frame starts.
+            self.stream = open_zstd(self.file)
+        elif archive_format != TAR:
+            self.file.close()
+            self.stream = open_archive(path)
+        self.data = b''
+        self.chunk = memoryview(b'')
+
+    def __fill(self):
+        if self.stream is not None:
+            self.chunk = memoryview(self.stream.read(CHUNK_SIZE))
+            return bool(self.chunk)
+        if not self.gzipped:
+            self.chunk = memoryview(self.file.read(CHUNK_SIZE))
+            return bool(self.chunk)
+
+        while True:
+            if not self.data:
+                self.data = self.file.read(CHUNK_SIZE)
+                if not self.data:
+                    return False
+            if self.d.eof:
+                data = self.data.lstrip(b'\x00')
+                self.compressed += len(self.data) - len(data)
+                self.data = data
+                if not self.data:
+                    continue
+                self.d = zlib.decompressobj(wbits=31)
+                if self.on_checkpoint is not None:
+                    self.on_checkpoint(self.compressed, self.position)
+                    self.last_checkpoint = self.position
+            elif self.on_checkpoint is not None and self.position \
+                    - self.last_checkpoint >= CHECKPOINT_SPACING:
+                self.on_checkpoint(self.compressed, self.position,
+                                   self.d.copy())
+                self.last_checkpoint = self.position
+            chunk = self.d.decompress(self.data, CHUNK_SIZE)
+            rest = self.d.unused_data if self.d.eof \
+                   else self.d.unconsumed_tail
+            self.compressed += len(self.data) - len(rest)
+            self.data = rest
+            if chunk:
+                self.chunk = memoryview(chunk)
+                return True
+
+    def read(self, size):
+        """Read up to size bytes from the current position.
+
+        Arguments:
+            size {int} -- The maximum number of bytes.
+
+        Returns:
+            memoryview -- The data, empty at the end of the archive.
+        """
+
+        if not self.chunk and not self.__fill():
+            return memoryview(b'')
+        data = self.chunk[:size]
+        self.chunk = self.chunk[size:]
+        self.position += len(data)
+        return data
+
+    def skip(self, size):
+        """Discard size bytes from the current position.
+
+        Arguments:
+            size {int} -- The number of bytes.
+        """
+
+        while size > 0:
+            n = len(self.read(size))
+            if not n:
+                raise EOFError('Unexpected end of archive.')
+            size -= n
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class GzipIndex(object):
+    def __init__(self, archive):
+        """GzipIndex constructor.
+
+        Arguments:
+            archive {str} -- The path of the indexed archive.
+        """
+
+        super().__init__()
+        self.archive = archive
+        self.archive_size = None
+        self.archive_mtime = None
+        self.fingerprint = None
+        self.format = None
+        self.members = {}
+        self.__checkpoints = []
+        self.__offsets = []
+        self.__lock = Lock()
+
+    @classmethod
+    def load_or_build(cls, archive, member_filter=None):
+        """Load the side-car index of the archive, building it if it's
+        missing or stale.
+
+        Arguments:
+            archive {str} -- The path of the archive.
+
+        Keyword Arguments:
+            member_filter {callable} -- Filter of the indexed members, as
+                                        used by StreamExtractor.
+                                        (default: {None})
+
+        Returns:
+            GzipIndex -- The index.
+        """
+
+        index = cls(archive)
+        if not index.load():
+            index.build(member_filter).save()
+        return index
+
+    def add_checkpoint(self, compressed, uncompressed, state=None):
+        """Add a point from which the archive can be inflated.
+
+        Arguments:
+            compressed {int} -- Offset of the first compressed byte to feed.
+            uncompressed {int} -- The matching uncompressed offset.
+
+        Keyword Arguments:
+            state {zlib.Decompress} -- The decompressor state, or None if a
+                                       gzip member starts at the offset.
+                                       (default: {None})
+        """
+
+        with self.__lock:
+            i = bisect.bisect_right(self.__offsets, uncompressed)
+            if i and self.__offsets[i - 1] == uncompressed:
+                # Stateless checkpoints are preferred since they're saved.
+                if state is None:
+                    self.__checkpoints[i - 1] = (compressed, uncompressed,
+                                                 None)
+                return
+            self.__offsets.insert(i, uncompressed)
+            self.__checkpoints.insert(i, (compressed, uncompressed, state))
+
+    def checkpoint_before(self, offset):
+        """Get the nearest checkpoint preceding the uncompressed offset.
+
+        Arguments:
+            offset {int} -- The uncompressed offset.
+
+        Returns:
+            tuple -- The (compressed, uncompressed, state) tuple.
+        """
+
+        with self.__lock:
+            i = bisect.bisect_right(self.__offsets, offset)
+            return self.__checkpoints[i - 1] if i else (0, 0, None)
+
+    def build(self, member_filter=None):
+        """Scan the archive once, recording the offsets of the members and
+        the checkpoints preceding them.
+
+        Keyword Arguments:
+            member_filter {callable} -- Filter of the indexed members.
+                                        (default: {None})
+
+        Returns:
+            GzipIndex -- self
+        """
+
+        stat = os.stat(self.archive)
+        self.archive_size = stat.st_size
+        self.archive_mtime = stat.st_mtime_ns
+        self.fingerprint = Manifest.compute_fingerprint(self.archive,
+                                                        stat.st_size)
+        self.format = detect_format(self.archive)
+        gzipped = self.format == GZIP
+
+        self.members = {}
+        if gzipped:
+            reader = _IndexingReader(self.archive)
+        elif self.format == TAR:
+            reader = open(self.archive, 'rb', buffering=CHUNK_SIZE)
+        else:
+            reader = open_archive(self.archive)
+        with reader, tarfile.open(fileobj=reader, mode='r|') as tar:
+            for member in tar:
+                name = StreamExtractor.normalize_name(member.name)
+                if name is None or not member.isfile():
+                    continue
+                if member_filter is not None \
+                        and not member_filter(name, member):
+                    continue
+                self.members[name] = (member.offset_data, member.size)
+                if gzipped:
+                    checkpoint = reader.checkpoint_before(member.offset_data)
+                    if checkpoint is not None:
+                        self.add_checkpoint(*checkpoint)
+
+        if gzipped:
+            for compressed, uncompressed in reader.member_starts:
+                self.add_checkpoint(compressed, uncompressed)
+        elif self.format == ZSTD:
+            for compressed, uncompressed, _, _ \
+                    in read_seek_table(self.archive) or []:
+                self.add_checkpoint(compressed, uncompressed)
+
+        return self
+
+    def save(self):
+        """Write the index next to the archive.  Only the checkpoints at
+        gzip member starts are kept, since the others hold decompressor
+        states that can't be serialized.
+
+        Returns:
+            GzipIndex -- self
+        """
+
+        with self.__lock:
+            checkpoints = [c[:2] for c in self.__checkpoints if c[2] is None]
+        path = index_path(self.archive)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'archive_size': self.archive_size,
+                       'archive_mtime': self.archive_mtime,
+                       'fingerprint': self.fingerprint,
+                       'format': self.format,
+                       'members': self.members,
+                       'checkpoints': checkpoints}, f)
+        os.replace(path + '.tmp', path)
+
+        return self
+
+    def load(self):
+        """Load the index of the archive if it's still up to date.
+
+        Returns:
+            bool -- True if the index was loaded, False otherwise.
+        """
+
+        try:
+            with open(index_path(self.archive)) as f:
+                data = json.load(f)
+            stat = os.stat(self.archive)
+            if data['archive_size'] != stat.st_size \
+                    or data['archive_mtime'] != stat.st_mtime_ns \
+                    or data['fingerprint'] != Manifest.compute_fingerprint(
+                        self.archive, stat.st_size):
+                return False
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+
+        self.archive_size = data['archive_size']
+        self.archive_mtime = data['archive_mtime']
+        self.fingerprint = data['fingerprint']
+        self.format = data['format']
+        self.members = {name: tuple(value)
+                        for name, value in data['members'].items()}
+        for compressed, uncompressed in data['checkpoints']:
+            self.add_checkpoint(compressed, uncompressed)
+
+        return True
+
+    def extract(self, names, destination, buffer_size=CHUNK_SIZE):
+        """Extract the given members by inflating only from the nearest
+        checkpoint preceding each of them.  The members of an uncompressed
+        archive are copied by the kernel instead.
+
+        Arguments:
+            names {iterable} -- Names of the members to extract.
+            destination {str} -- The folder in which they are written.
+
+        Keyword Arguments:
+            buffer_size {int} -- Maximum size of each write.
+                                 (default: {CHUNK_SIZE})
+
+        Returns:
+            list -- List of (name, size) tuples for the extracted files.
+        """
+
+        extracted = []
+        reader = None
+        files = OutputFiles()
+        source = buffer = None
+        if self.format == TAR:
+            source = open(self.archive, 'rb')
+            buffer = aligned_buffer(buffer_size)
+        try:
+            for name in sorted(names, key=lambda x: self.members[x][0]):
+                offset, size = self.members[name]
+                path = os.path.join(destination, name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+
+                if source is not None:
+                    fd = files.open(path, size)
+                    try:
+                        copy_range(source, fd, offset, size, buffer)
+                    finally:
+                        os.close(fd)
+                    extracted.append((name, size))
+                    continue
+
+                # Keep inflating sequentially unless a checkpoint gets closer
+                # to the member than the current position.
+                checkpoint = self.checkpoint_before(offset)
+                if reader is None or reader.position > offset \
+                        or reader.position < checkpoint[1]:
+                    if reader is not None:
+                        reader.close()
+                    reader = _RangeReader(self.archive, self.format,
+                                          checkpoint, self.add_checkpoint)
+                reader.skip(offset - reader.position)
+
+                fd = files.open(path, size)
+                try:
+                    remaining = size
+                    while remaining:
+                        data = reader.read(min(remaining, buffer_size))
+                        if not data:
+                            raise EOFError('Unexpected end of archive.')
+                        write_all(fd, data)
+                        remaining -= len(data)
+                finally:
+                    os.close(fd)
+                extracted.append((name, size))
+        finally:
+            files.close()
+            if source is not None:
+                source.close()
+            if reader is not None:
+                reader.close()
+
+        return extracted
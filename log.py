@@ -1,13 +1,29 @@
+import bisect
 import re
 import os
-import subprocess
 import settings
 import shutil
-from threading import Thread
-from utils import get_next_free_port
+import time
+from threading import Lock
+from extractor import StreamExtractor
+from store import ContentStore
+from decompress import TAR, ZSTD, open_archive, detect_format, read_seek_table
+from manifest import Manifest
+from gzindex import GzipIndex, index_path, open_at, restart_points
+from recompress import recompress_archive
+from discovery import Workspace
+from stats import Stats
+from cache import ExtractionCache
+from prefetch import Prefetcher
+import supervisor
 
 class Log(object):
-    ARCHIVE_REGEX = re.compile(r'node(.*)_log\.tgz')
+    __slots__ = ('archive', 'node_name', 'folder', 'locations', 'index',
+                 '__manifest_lock', '__index_lock')
+    # The format is detected from the content, the extension only tells the
+    # archives apart from the other files.
+    ARCHIVE_REGEX = re.compile(
+        r'node(.*)_log\.(?:tgz|tzst|txz|tar(?:\.(?:gz|zst|lz4|xz|bz2))?)$')
     assert(ARCHIVE_REGEX.groups == 1)
 
     def __init__(self, node_name, archive=None):
@@ -26,8 +42,147 @@ class Log(object):
         self.node_name = node_name.capitalize()
         self.folder = settings.settings.folder_format % self.node_name
         self.locations = {}
+        self.index = None
+        self.__manifest_lock = Lock()
+        self.__index_lock = Lock()
         self.__map_locations()
 
+    def load_index(self):
+        """Scan the archive into a seek index instead of extracting it, so
+        each location is only extracted when it's first needed.  Files
+        extracted from another archive are removed.
+
+        Raises:
+            Exception: The log has no archive to index.
+
+        Returns:
+            Log -- self
+        """
+
+        if self.archive is None:
+            raise Exception('No archive found for node {}.'\
+                            .format(self.node_name))
+
+        if settings.settings.verbose_level > 1:
+            print('Indexing archive {}.'.format(self.archive))
+        with Stats.get_instance().timer(self.node_name, 'index') as counter:
+            self.index = GzipIndex.load_or_build(
+                self.archive,
+                self.__member_filter(settings.settings.extract_all))
+            counter['bytes'] = os.path.getsize(self.archive)
+
+        # The manifest records the archive the folder's files come from, so
+        # they're never served once the archive is replaced.
+        with self.__manifest_lock:
+            manifest = Manifest.load(self.folder)
+            if manifest is None \
+                    or not manifest.matches_archive(self.archive):
+                if os.path.exists(self.folder):
+                    if settings.settings.verbose_level > 1:
+                        print('Removing outdated folder {}.'.format(
+                            self.folder))
+                    with Stats.get_instance().timer(self.node_name,
+                                                    'rmtree'):
+                        shutil.rmtree(self.folder)
+                    self.locations = {}
+                manifest = Manifest.for_archive(self.folder, self.archive)
+                manifest.all_files = settings.settings.extract_all
+                manifest.save()
+
+        return self.__map_locations()
+
+    def extract_location(self, location):
+        """Extract the missing or truncated files of a location using the seek
+        index.
+
+        Arguments:
+            location {LogLocation} -- The location to extract.
+
+        Returns:
+            Log -- self
+        """
+
+        if self.index is None:
+            # Evicted locations are extracted again from the archive.
+            if not self.__has_evicted(location) or self.archive is None:
+                return self
+            # Locations of the node starting together share a single scan.
+            with self.__index_lock:
+                if self.index is None:
+                    self.index = GzipIndex.load_or_build(
+                        self.archive,
+                        self.__member_filter(settings.settings.extract_all))
+
+        names = [name for name in self.index.members
+                 if name.split(os.sep)[0] == location.name
+                 and not self.__is_extracted(name)]
+        if names:
+            if settings.settings.verbose_level > 1:
+                print('Extracting {} files of {}.{}.'.format(
+                    len(names), self.node_name, location.id))
+            with Stats.get_instance().timer(
+                    '{}.{}'.format(self.node_name, location.id),
+                    'extract') as counter:
+                extracted = self.index.extract(names, self.folder,
+                                               settings.settings.buffer_size)
+                counter['bytes'] = sum(self.index.members[x][1]
+                                       for x in names)
+
+            with self.__manifest_lock:
+                manifest = Manifest.load(self.folder)
+                if manifest is not None:
+                    manifest.members.update(extracted)
+                    manifest.evicted.difference_update(names)
+                    manifest.save()
+
+        return self
+
+    def __is_extracted(self, name):
+        try:
+            size = os.path.getsize(os.path.join(self.folder, name))
+        except OSError:
+            return False
+        return size == self.index.members[name][1]
+
+    def evict_location(self, location):
+        """Remove the extracted files of a location to free disk space.  Its
+        folder is kept, so the location is still listed, and the files are
+        extracted again from the archive when it's next started.
+
+        Arguments:
+            location {LogLocation} -- The location to evict.
+
+        Returns:
+            int -- The number of bytes freed.
+        """
+
+        freed = 0
+        names = []
+        for root, _, files in os.walk(location.folder):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    size = os.path.getsize(path)
+                    os.remove(path)
+                except OSError:
+                    continue
+                freed += size
+                names.append(os.path.relpath(path, self.folder))
+
+        with self.__manifest_lock:
+            manifest = Manifest.load(self.folder)
+            if manifest is not None:
+                manifest.evicted.update(names)
+                manifest.save()
+
+        return freed
+
+    def __has_evicted(self, location):
+        manifest = Manifest.load(self.folder)
+        return manifest is not None and any(
+            name.split(os.sep)[0] == location.name
+            for name in manifest.evicted)
+
     def extract(self):
         """Extract the archive to a folder.
 
@@ -42,27 +197,228 @@ class Log(object):
             raise Exception('No archive found for node {}.'\
                             .format(self.node_name))
 
-        # If the folder exists at the current path, remove it.
-        if self.folder in os.listdir():
+        # If the folder was already extracted from this same archive, only
+        # the missing or corrupted members need to be extracted again.
+        manifest = Manifest.load(self.folder)
+        if manifest is not None and manifest.matches_archive(self.archive) \
+                and manifest.all_files >= settings.settings.extract_all:
+            missing = set(manifest.missing_members())
+            if manifest.complete and not missing:
+                if settings.settings.verbose_level > 1:
+                    print('Folder {} is up to date.'.format(self.folder))
+            elif manifest.resume is not None and not missing:
+                # Interrupted after a checkpoint, the members recorded so far
+                # are intact.
+                if settings.settings.verbose_level > 1:
+                    print('Resuming the extraction of {} at {:.1f} MiB.'
+                          .format(self.archive,
+                                  manifest.resume[2] / 1024 / 1024))
+                self.__extract_members(
+                    manifest, self.__member_filter(manifest.all_files),
+                    manifest.resume)
+            else:
+                if settings.settings.verbose_level > 1:
+                    print('Repairing {} members in {}.'.format(
+                        len(missing) if manifest.complete else 'all',
+                        self.folder))
+                if manifest.complete:
+                    member_filter = lambda name, member: name in missing
+                else:
+                    member_filter = self.__member_filter(manifest.all_files)
+                self.__extract_members(manifest, member_filter)
+        else:
+            # If the folder exists at the current path, remove it.
+            if self.folder in os.listdir():
+                if settings.settings.verbose_level > 1:
+                    print('Removing existing folder {}.'.format(self.folder))
+                with Stats.get_instance().timer(self.node_name, 'rmtree'):
+                    shutil.rmtree(self.folder)
+
+            # Extract the archive.  Unless all files were requested, only the
+            # location folders and their trace files are written to disk.
             if settings.settings.verbose_level > 1:
-                print('Removing existing folder {}.'.format(self.folder))
-            shutil.rmtree(self.folder)
-
-        # Extract the archive.
-        if settings.settings.verbose_level > 1:
-            print('Extracting archive {} to {}.'.format(self.archive,
-                                                        self.folder))
-        shutil.unpack_archive(self.archive, self.folder)
-
-        # Remove the archive if needed.
+                print('Extracting archive {} to {}.'.format(self.archive,
+                                                            self.folder))
+            manifest = Manifest.for_archive(self.folder, self.archive)
+            manifest.all_files = settings.settings.extract_all
+            self.__extract_members(manifest,
+                                   self.__member_filter(manifest.all_files))
+
+        # Remove the archive if needed.  It's the only copy of the data
+        # until the extraction is verified and flushed to the disk, and of
+        # the evicted members, which are extracted again first.
         if not settings.settings.keep_archives:
-            if settings.settings.verbose_level > 1:
-                print('Removing archive {}'.format(self.archive))
-            os.remove(self.archive)
+            if manifest.evicted:
+                evicted = set(manifest.evicted)
+                if settings.settings.verbose_level > 1:
+                    print('Restoring {} evicted members in {}.'.format(
+                        len(evicted), self.folder))
+                self.__extract_members(manifest,
+                                       lambda name, member: name in evicted)
+                with self.__manifest_lock:
+                    manifest.evicted.clear()
+                    manifest.save()
+
+            if manifest.evicted or not manifest.is_complete():
+                print('Keeping archive {}, its extraction is incomplete.'
+                      .format(self.archive))
+            else:
+                if settings.settings.verbose_level > 1:
+                    print('Removing archive {}'.format(self.archive))
+                manifest.sync()
+                os.remove(self.archive)
 
         # Create the node locations objects.
         return self.__map_locations()
     
+    def recompress(self, threads=None):
+        """Convert the archive to seekable zstd, which is decompressed in
+        parallel and from any of its frames.  An extraction of the old
+        archive stays valid for the new one.
+
+        Keyword Arguments:
+            threads {int} -- Number of compression threads.  If None, the
+                             settings value or the number of CPUs is used.
+                             (default: {None})
+
+        Raises:
+            Exception: The log has no archive to recompress.
+
+        Returns:
+            bool -- True if the archive was converted, False if it was
+                    already seekable zstd.
+        """
+
+        if self.archive is None:
+            raise Exception('No archive found for node {}.'\
+                            .format(self.node_name))
+        if detect_format(self.archive) == ZSTD \
+                and read_seek_table(self.archive) is not None:
+            return False
+
+        threads = threads or settings.settings.decompress_threads \
+                  or os.cpu_count() or 1
+        folder, name = os.path.split(self.archive)
+        target = os.path.join(folder, 'node{}_log.tar.zst'.format(
+            self.ARCHIVE_REGEX.match(name).group(1)))
+
+        with self.__manifest_lock:
+            manifest = Manifest.load(self.folder)
+            if manifest is not None \
+                    and not manifest.matches_archive(self.archive):
+                manifest = None
+
+            if settings.settings.verbose_level > 1:
+                print('Recompressing {} to {}.'.format(self.archive, target))
+            recompress_archive(self.archive, target, threads)
+
+            # The content is the same, only the archive it came from changed.
+            if manifest is not None:
+                new = Manifest.for_archive(self.folder, target)
+                manifest.archive_size = new.archive_size
+                manifest.archive_mtime = new.archive_mtime
+                manifest.fingerprint = new.fingerprint
+                manifest.save()
+
+        for path in (index_path(self.archive),
+                     self.archive if target != self.archive else None):
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+        self.archive = target
+        if self.index is not None:
+            self.index = GzipIndex.load_or_build(
+                self.archive,
+                self.__member_filter(settings.settings.extract_all))
+
+        return True
+
+    def is_complete(self):
+        """Check if the node folder holds a complete extraction.  Folders
+        without a manifest are assumed to be complete.
+
+        Returns:
+            bool -- True if complete, False otherwise.
+        """
+
+        if not os.path.exists(self.folder):
+            return False
+        manifest = Manifest.load(self.folder)
+        return manifest is None or manifest.is_complete()
+
+    def __member_filter(self, all_files):
+        return None if all_files else self.is_trace_member
+
+    def __extract_members(self, manifest, member_filter, resume=None):
+        """Extract the archive members accepted by the filter and record them
+        in the manifest.  The manifest is marked incomplete until the
+        extraction finishes, and the members written so far are recorded
+        along with a resume point every few seconds.
+
+        Arguments:
+            manifest {Manifest} -- The manifest of the folder.
+            member_filter {None, callable} -- The member filter.
+
+        Keyword Arguments:
+            resume {list} -- The resume point of an interrupted extraction
+                             to continue. (default: {None})
+        """
+
+        manifest.complete = False
+        manifest.save()
+
+        archive_format = detect_format(self.archive)
+        points = restart_points(self.archive, archive_format)
+        starts = [uncompressed for _, uncompressed in points or []]
+
+        def checkpoint(done, position):
+            manifest.members.update(done)
+            manifest.digests.update(extractor.digests)
+            if points is None:
+                manifest.resume = [position, position, position]
+            else:
+                point = points[bisect.bisect_right(starts, position) - 1]
+                manifest.resume = [point[0], point[1], position]
+            manifest.save()
+
+        # Plain tar archives are read with random access, so the members
+        # already extracted are simply skipped.
+        if resume is not None and points is None:
+            previous_filter = member_filter
+            member_filter = lambda name, member: member.offset >= resume[2] \
+                and (previous_filter is None or previous_filter(name, member))
+
+        # Decompression, tar parsing and file writes run on separate threads
+        # when more than one core is available.
+        threads = settings.settings.decompress_threads or os.cpu_count() or 1
+        stats = Stats.get_instance()
+        store = ContentStore.get_instance() if settings.settings.dedup \
+            else None
+        extractor = StreamExtractor(self.folder, member_filter,
+                                    settings.settings.buffer_size, threads > 1,
+                                    store, checkpoint)
+        with stats.timer(self.node_name, 'extract') as counter:
+            counter['bytes'] = os.path.getsize(self.archive)
+            if archive_format == TAR:
+                # Uncompressed members are copied straight from the archive.
+                extracted = extractor.extract(self.archive)
+            elif resume is not None:
+                with open_at(self.archive, resume, resume[2],
+                             archive_format) as stream:
+                    extracted = extractor.extract(stream, resume[2])
+            else:
+                with open_archive(self.archive, threads) as stream:
+                    extracted = extractor.extract(stream)
+        stats.add(self.node_name, 'write', extractor.write_time,
+                  sum(size for _, size in extracted))
+        if store is not None:
+            stats.add(self.node_name, 'dedup', nbytes=extractor.deduplicated)
+
+        manifest.members.update(extracted)
+        manifest.digests.update(extractor.digests)
+        manifest.complete = True
+        manifest.resume = None
+        manifest.save()
+
     def start_osc(self, location_id=None):
         """Start oscilloscope on the specified location.
 
@@ -81,12 +437,8 @@ class Log(object):
                                           .format(location_id.capitalize(),
                                                   self.node_name.capitalize()))
         else:
-            threads = []
             for location in self.locations.values():
-                threads.append(Thread(target=location.start_osc))
-                threads[-1].start()
-            for t in threads:
-                t.join()
+                location.start_osc()
 
         return self
 
@@ -110,11 +462,33 @@ class Log(object):
                                           .format(location_id.capitalize(),
                                                   self.node_name.capitalize()))
         else:
-            for location in self.locations.values():
-                location.stop_osc(verbose=False)
+            supervisor.Supervisor.get_instance().stop_all(
+                self.locations.values())
 
         return self
 
+    @classmethod
+    def is_trace_member(cls, name, member=None):
+        """Check if an archive member is needed by oscilloscope, meaning it's
+        either a location folder or a trace file directly under one.
+
+        Arguments:
+            name {str} -- The normalized member name.
+
+        Keyword Arguments:
+            member {TarInfo} -- The archive member. (default: {None})
+
+        Returns:
+            bool -- True if the member should be extracted, False otherwise.
+        """
+
+        parts = name.split(os.sep)
+        if not cls.LogLocation.LOCATION_REGEX.match(parts[0]):
+            return False
+        if len(parts) == 1:
+            return member is None or member.isdir()
+        return len(parts) == 2 and parts[1] in cls.LogLocation.TRACE_FILES
+
     def __map_locations(self):
         """Create the locations for this node log.
         
@@ -122,22 +496,37 @@ class Log(object):
             Log -- self
         """
 
-        if os.path.exists(self.folder):
-            # Get the location folders directly under the log folder.
-            subdirs = next(os.walk(self.folder))[1]
-            p = self.LogLocation.LOCATION_REGEX
-            locations = filter(lambda x: p.match(x), subdirs)
+        # Get the location folders directly under the log folder.
+        started = time.perf_counter()
+        locations = Workspace.get_instance().location_folders(
+            self.folder, self.LogLocation.LOCATION_REGEX)
 
-            # Create the location objects
-            for location in locations:
-                log_location = self.LogLocation(self, location)
-                self.locations[log_location.id.lower()] = log_location
-        
+        # Create the location objects
+        for location in locations:
+            log_location = self.LogLocation(self, location)
+            self.locations[log_location.id.lower()] = log_location
+
+        # Locations which are indexed but not extracted yet.
+        if self.index is not None:
+            p = self.LogLocation.LOCATION_REGEX
+            for name in self.index.members:
+                location = name.split(os.sep)[0]
+                match = p.match(location)
+                if match and match.group('id').lower() not in self.locations:
+                    log_location = self.LogLocation(self, location)
+                    self.locations[log_location.id.lower()] = log_location
+
+        Stats.get_instance().add(self.node_name, 'map_locations',
+                                 time.perf_counter() - started)
         return self
 
     class LogLocation(object):
+        __slots__ = ('log', 'id', 'name', 'port', 'osc_proc', 'osc_state',
+                     'osc_started', 'osc_load_time', 'osc_restarts',
+                     'osc_task', '__extract_lock')
         LOCATION_REGEX = re.compile(r'location(?P<id>[1-9][0-9]*)')
         assert(LOCATION_REGEX.groups == 1)
+        TRACE_FILES = ('ipstrc.drw', 'ipstrc.dmp')
 
         def __init__(self, log, location):
             """LogLocation constructor.
@@ -150,17 +539,94 @@ class Log(object):
             super().__init__()
             self.log = log
             self.id = self.LOCATION_REGEX.match(location).group('id')
-            self.folder = os.path.join(self.log.folder, location)
+            self.name = location
             self.port = None
             self.osc_proc = None
+            self.osc_state = None
+            self.osc_started = None
+            self.osc_load_time = None
+            self.osc_restarts = 0
+            self.osc_task = None
+            self.__extract_lock = Lock()
+
+        @property
+        def folder(self):
+            """The path of the location folder."""
+
+            return os.path.join(self.log.folder, self.name)
+
+        def ensure_extracted(self):
+            """Extract the trace files of this location if they're still
+            only in the archive.
+
+            Returns:
+                LogLocation -- self
+            """
+
+            with self.__extract_lock:
+                self.log.extract_location(self)
+
+            # Extracting an evicted location again may go over the budget.
+            ExtractionCache.get_instance().enforce()
+
+            return self
+
+        def evict(self):
+            """Remove the extracted files of this location, unless its
+            oscilloscope is running or starting.
+
+            Returns:
+                int -- The number of bytes freed.
+            """
+
+            if not self.__extract_lock.acquire(blocking=False):
+                return 0
+            try:
+                if self.osc_proc is not None or self.osc_state is not None \
+                        or (self.osc_task is not None
+                            and not self.osc_task.done()):
+                    return 0
+                return self.log.evict_location(self)
+            finally:
+                self.__extract_lock.release()
+
+        @property
+        def url(self):
+            """The URL on which the oscilloscope of this location is viewed,
+            either directly or through the front door."""
+
+            if settings.settings.proxy:
+                return 'http://localhost:{}/{}/{}/'.format(
+                    settings.settings.first_port, self.log.node_name.lower(),
+                    self.id.lower())
+            return 'http://localhost:{}'.format(self.port)
+
+        def osc_command(self):
+            """Get the command line starting oscilloscope on this location.
+
+            Returns:
+                list -- The program and its arguments.
+            """
+
+            return [settings.settings.osc_path, '-p', str(self.port)] \
+                + [os.path.join(self.folder, trace_file)
+                   for trace_file in self.TRACE_FILES]
 
         def start_osc(self):
-            """Start oscilloscope for this location.
+            """Queue the start of oscilloscope for this location.  The browser
+            is opened once it's listening.  Behind the front door, the process
+            is only started by the first request reaching it.
             
             Returns:
                 LogLocation -- self
             """
 
+            ExtractionCache.get_instance().touch(self)
+            osc_supervisor = supervisor.Supervisor.get_instance()
+            if settings.settings.proxy:
+                osc_supervisor.submit(osc_supervisor.open_browser(self))
+                return self
+
             # If process is already running, print the port on which it can be
             # found
             if self.osc_proc is not None:
@@ -172,29 +638,10 @@ class Log(object):
             print('Starting oscilloscope on {}.{}...'\
                                        .format(self.log.node_name.capitalize(),
                                                self.id.capitalize()))
-            if self.port is None:
-                self.port = get_next_free_port()
-
-            # Set the oscilloscope port and file paths to use
-            osc_options = '-p {}'.format(self.port)
-            osc_files = ' '.join([os.path.join(self.folder, 'ipstrc.' + ext)
-                                for ext in ['drw', 'dmp']])
-            osc_cmd = 'oscilloscope.exe {} {}'.format(osc_options, osc_files)
-
-            print('{}.{} -> {}'.format(self.log.node_name.capitalize(),
-                                    self.id.capitalize(),
-                                    self.port))
-            self.osc_proc = subprocess.Popen(osc_cmd,
-                                             stdout=subprocess.DEVNULL,
-                                             stderr=subprocess.STDOUT)
-            browser_cmd = '{}http://localhost:{}'\
-                            .format(settings.settings._browser_start_string,
-                                    self.port)
-            self.browser_proc = subprocess.Popen(browser_cmd,
-                                                 stdout=subprocess.DEVNULL,
-                                                 stderr=subprocess.STDOUT,
-                                                 shell=True)
-            
+            # The trace files are read in while the start waits its turn.
+            Prefetcher.get_instance().prefetch(self)
+            osc_supervisor.start(self)
+
             return self
 
         def stop_osc(self, verbose=True):
@@ -204,14 +651,6 @@ class Log(object):
                 LogLocation -- self
             """
 
-            if self.osc_proc is not None:
-                print('Stopping oscilloscope on {}.{}'\
-                                          .format(self.log.node_name, self.id))
-                self.osc_proc.kill()
-                self.osc_proc = None
-            else:
-                if verbose:
-                    print('Oscilloscope not running on {}.{}'\
-                                          .format(self.log.node_name, self.id))
+            supervisor.Supervisor.get_instance().stop(self, verbose)
             
             return self
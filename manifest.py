@@ -0,0 +1,263 @@
+import hashlib
+import json
+import os
+from store import ContentStore
+
+MANIFEST_FILE = '.untar_manifest.json'
+SAMPLE_SIZE = 1024 * 1024
+
+class Manifest(object):
+    def __init__(self, folder, archive_size=None, archive_mtime=None,
+                 fingerprint=None, members=None, complete=False,
+                 all_files=False, evicted=None, digests=None, resume=None):
+        """Manifest constructor.
+
+        Arguments:
+            folder {str} -- The extraction folder the manifest describes.
+
+        Keyword Arguments:
+            archive_size {int} -- Size of the source archive.
+                                  (default: {None})
+            archive_mtime {int} -- Modification time of the source archive,
+                                   in nanoseconds. (default: {None})
+            fingerprint {str} -- Content fingerprint of the source archive.
+                                 (default: {None})
+            members {dict} -- Mapping of extracted member names to their
+                              sizes. (default: {None})
+            complete {bool} -- Whether the extraction finished.
+                               (default: {False})
+            all_files {bool} -- Whether every member was extracted, not
+                                only the trace files. (default: {False})
+            evicted {list} -- Names of the members removed from the disk
+                              to save space, which are extracted again on
+                              demand. (default: {None})
+            digests {dict} -- Mapping of extracted member names to the hex
+                              digest of their content, when deduplicating.
+                              (default: {None})
+            resume {list} -- Where an interrupted extraction continues: the
+                             compressed and uncompressed offsets of a
+                             restart point of the decompressor, and the
+                             offset of the first member header not
+                             extracted yet. (default: {None})
+        """
+
+        super().__init__()
+        self.folder = folder
+        self.archive_size = archive_size
+        self.archive_mtime = archive_mtime
+        self.fingerprint = fingerprint
+        self.members = members if members is not None else {}
+        self.complete = complete
+        self.all_files = all_files
+        self.evicted = set(evicted) if evicted is not None else set()
+        self.digests = digests if digests is not None else {}
+        self.resume = resume
+
+    @classmethod
+    def for_archive(cls, folder, archive):
+        """Create an empty manifest describing the given archive.
+
+        Arguments:
+            folder {str} -- The extraction folder.
+            archive {str} -- The path of the archive.
+
+        Returns:
+            Manifest -- The new manifest.
+        """
+
+        stat = os.stat(archive)
+        return cls(folder, stat.st_size, stat.st_mtime_ns,
+                   cls.compute_fingerprint(archive, stat.st_size))
+
+    @classmethod
+    def load(cls, folder):
+        """Load the manifest of an extraction folder.
+
+        Arguments:
+            folder {str} -- The extraction folder.
+
+        Returns:
+            {None, Manifest} -- The manifest or None if it's missing or
+                                unreadable.
+        """
+
+        try:
+            with open(os.path.join(folder, MANIFEST_FILE)) as f:
+                data = json.load(f)
+            return cls(folder, data['archive_size'], data['archive_mtime'],
+                       data['fingerprint'], data['members'],
+                       data['complete'], data.get('all_files', False),
+                       data.get('evicted'), data.get('digests'),
+                       data.get('resume'))
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self):
+        """Write the manifest in its folder, atomically.
+
+        Returns:
+            Manifest -- self
+        """
+
+        os.makedirs(self.folder, exist_ok=True)
+        path = os.path.join(self.folder, MANIFEST_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'archive_size': self.archive_size,
+                       'archive_mtime': self.archive_mtime,
+                       'fingerprint': self.fingerprint,
+                       'members': self.members,
+                       'complete': self.complete,
+                       'all_files': self.all_files,
+                       'evicted': sorted(self.evicted),
+                       'digests': self.digests,
+                       'resume': self.resume}, f)
+        os.replace(path + '.tmp', path)
+
+        return self
+
+    @staticmethod
+    def compute_digest(path):
+        """Hash the content of an extracted file as the store does.
+
+        Arguments:
+            path {str} -- The file path.
+
+        Returns:
+            str -- The hex digest.
+        """
+
+        h = ContentStore.hasher()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(SAMPLE_SIZE), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    @staticmethod
+    def compute_fingerprint(archive, size=None):
+        """Compute a fast fingerprint of the archive by hashing its size and
+        samples from its start, middle and end.
+
+        Arguments:
+            archive {str} -- The path of the archive.
+
+        Keyword Arguments:
+            size {int} -- The size of the archive, if already known.
+                          (default: {None})
+
+        Returns:
+            str -- The fingerprint.
+        """
+
+        if size is None:
+            size = os.path.getsize(archive)
+
+        h = hashlib.blake2b(str(size).encode(), digest_size=16)
+        with open(archive, 'rb') as f:
+            for offset in (0, size // 2, size - SAMPLE_SIZE):
+                f.seek(max(offset, 0))
+                h.update(f.read(SAMPLE_SIZE))
+        return h.hexdigest()
+
+    def matches_archive(self, archive):
+        """Check if the manifest was created from the given archive, as it
+        currently is.
+
+        Arguments:
+            archive {str} -- The path of the archive.
+
+        Returns:
+            bool -- True if the archive is unchanged, False otherwise.
+        """
+
+        try:
+            stat = os.stat(archive)
+        except OSError:
+            return False
+        if stat.st_size != self.archive_size \
+                or stat.st_mtime_ns != self.archive_mtime:
+            return False
+        return self.compute_fingerprint(archive, stat.st_size) \
+            == self.fingerprint
+
+    def missing_members(self):
+        """Get the members which are missing or have a different size on
+        disk.  The deduplicated members are checked against their digest
+        instead, as a file sharing its content keeps its size when it's
+        overwritten.  Evicted members aren't expected on disk.
+
+        Returns:
+            list -- The names of the members.
+        """
+
+        missing = []
+        # Files sharing an inode are only hashed once.
+        hashed = {}
+        for name, size in self.members.items():
+            if name in self.evicted:
+                continue
+            path = os.path.join(self.folder, name)
+            try:
+                stat = os.stat(path)
+                if stat.st_size != size:
+                    missing.append(name)
+                    continue
+                digest = self.digests.get(name)
+                if digest is None:
+                    continue
+                key = (stat.st_dev, stat.st_ino)
+                if key not in hashed:
+                    hashed[key] = self.compute_digest(path)
+                if hashed[key] != digest:
+                    missing.append(name)
+            except OSError:
+                missing.append(name)
+        return missing
+
+    def is_complete(self):
+        """Check if the extraction finished and all its members are intact.
+
+        Returns:
+            bool -- True if complete, False otherwise.
+        """
+
+        return self.complete and not self.missing_members()
+
+    def sync(self):
+        """Flush the extracted members, the manifest and the folders listing
+        them to the disk.
+
+        Returns:
+            Manifest -- self
+        """
+
+        folders = set()
+        for name in list(self.members) + [MANIFEST_FILE]:
+            path = os.path.join(self.folder, name)
+            # Windows only flushes files opened for writing.
+            fd = os.open(path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            folders.add(os.path.dirname(path))
+
+        # Directories can't be opened on Windows, their entries are flushed
+        # with the files.
+        if os.name != 'nt':
+            root = os.path.abspath(self.folder)
+            folders = set(os.path.abspath(x) for x in folders)
+            synced = set()
+            while folders:
+                folder = folders.pop()
+                synced.add(folder)
+                fd = os.open(folder, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                # Up to the folder holding the extraction folder's entry.
+                parent = os.path.dirname(folder)
+                if folder != os.path.dirname(root) and parent not in synced:
+                    folders.add(parent)
+
+        return self
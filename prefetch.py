@@ -0,0 +1,207 @@
+import ctypes
+import os
+import queue
+import time
+from threading import Thread, Condition, Lock
+import settings
+from stats import Stats
+
+CHUNK_SIZE = 1024 * 1024
+# Seconds between two reads of the available memory while waiting.
+RECHECK_INTERVAL = 1
+
+def available_memory():
+    """Get the memory which can be used without swapping, page cache
+    included.
+
+    Returns:
+        {None, int} -- The size in bytes, or None if it's unknown.
+    """
+
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+
+    if os.name == 'nt':
+        class MemoryStatus(ctypes.Structure):
+            _fields_ = [('dwLength', ctypes.c_ulong),
+                        ('dwMemoryLoad', ctypes.c_ulong),
+                        ('ullTotalPhys', ctypes.c_ulonglong),
+                        ('ullAvailPhys', ctypes.c_ulonglong),
+                        ('ullTotalPageFile', ctypes.c_ulonglong),
+                        ('ullAvailPageFile', ctypes.c_ulonglong),
+                        ('ullTotalVirtual', ctypes.c_ulonglong),
+                        ('ullAvailVirtual', ctypes.c_ulonglong),
+                        ('ullAvailExtendedVirtual', ctypes.c_ulonglong)]
+        status = MemoryStatus()
+        status.dwLength = ctypes.sizeof(MemoryStatus)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullAvailPhys
+        return None
+
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def warm(path):
+    """Ask the kernel to read a file into the page cache in the background.
+    Without posix_fadvise, the file is read through instead.
+
+    Arguments:
+        path {str} -- The file path.
+    """
+
+    if hasattr(os, 'posix_fadvise'):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+        return
+
+    buf = bytearray(CHUNK_SIZE)
+    with open(path, 'rb', buffering=0) as f:
+        while f.readinto(buf):
+            pass
+
+class Prefetcher(object):
+    """Warm the page cache with the trace files of the locations queued for
+    oscilloscope, in the order they were queued, so they're read from
+    memory when their process loads them.  The files warmed for processes
+    which aren't ready yet are kept within a share of the available memory,
+    so the next locations of a batch are warmed as the first ones finish
+    loading."""
+
+    __instance = None
+    __instance_lock = Lock()
+
+    def __init__(self, memory_share=None):
+        """Prefetcher constructor.
+
+        Keyword Arguments:
+            memory_share {float} -- Share of the available memory the warmed
+                                    files may take, 0 to disable.
+                                    (default: {the settings value})
+        """
+
+        if Prefetcher.__instance is not None:
+            raise Exception('This class is a singleton!')
+
+        super().__init__()
+        self.memory_share = memory_share if memory_share is not None \
+                            else settings.settings.prefetch_memory
+        self.__queue = queue.Queue()
+        self.__pending = {}
+        self.__released = set()
+        self.__condition = Condition()
+        self.__thread = None
+        Prefetcher.__instance = self
+
+    @classmethod
+    def get_instance(cls):
+        """Get the Prefetcher instance.
+
+        Returns:
+            Prefetcher -- the Prefetcher instance
+        """
+
+        with cls.__instance_lock:
+            if cls.__instance is None:
+                cls()
+        return cls.__instance
+
+    def prefetch(self, location):
+        """Queue the trace files of a location to be warmed.
+
+        Arguments:
+            location {LogLocation} -- The location.
+
+        Returns:
+            Prefetcher -- self
+        """
+
+        if not self.memory_share:
+            return self
+
+        with self.__condition:
+            self.__released.discard(location.folder)
+            if self.__thread is None:
+                self.__thread = Thread(target=self.__run, daemon=True)
+                self.__thread.start()
+        self.__queue.put(location)
+        return self
+
+    def release(self, location):
+        """Record that a location's process loaded its files or won't, so
+        their memory can go to the next locations.
+
+        Arguments:
+            location {LogLocation} -- The location.
+
+        Returns:
+            Prefetcher -- self
+        """
+
+        with self.__condition:
+            if self.__pending.pop(location.folder, None) is None:
+                # Not warmed yet, it no longer needs to be.
+                self.__released.add(location.folder)
+            self.__condition.notify_all()
+        return self
+
+    def __files(self, location):
+        files = []
+        for name in location.TRACE_FILES:
+            path = os.path.join(location.folder, name)
+            try:
+                files.append((path, os.path.getsize(path)))
+            except OSError:
+                # Lazily indexed locations are warmed by their extraction.
+                pass
+        return files
+
+    def __reserve(self, location, size):
+        with self.__condition:
+            while True:
+                if location.folder in self.__released:
+                    self.__released.discard(location.folder)
+                    return False
+
+                available = available_memory()
+                if available is None:
+                    return False
+                limit = available * self.memory_share
+                pending = sum(self.__pending.values())
+                if pending + size <= limit:
+                    self.__pending[location.folder] = size
+                    return True
+                if not pending:
+                    # Too large to ever fit, warming would only evict it.
+                    return False
+                self.__condition.wait(RECHECK_INTERVAL)
+
+    def __run(self):
+        while True:
+            location = self.__queue.get()
+            files = self.__files(location)
+            size = sum(x[1] for x in files)
+            if not files or not self.__reserve(location, size):
+                continue
+
+            started = time.perf_counter()
+            for path, _ in files:
+                try:
+                    warm(path)
+                except OSError:
+                    pass
+            Stats.get_instance().add(
+                '{}.{}'.format(location.log.node_name, location.id),
+                'prefetch', time.perf_counter() - started, size)
+            if settings.settings.verbose_level > 2:
+                print('Prefetched {}.{} ({:.1f} MiB).'.format(
+                    location.log.node_name, location.id, size / 1024 / 1024))
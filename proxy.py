@@ -0,0 +1,334 @@
+import http.client
+import socket
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Event, Lock
+from urllib.parse import urlsplit
+import settings
+from supervisor import Supervisor
+from cache import ExtractionCache
+
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-authenticate',
+                      'proxy-authorization', 'te', 'trailers',
+                      'transfer-encoding', 'upgrade', 'host'}
+# Headers the proxy sets itself: send_response adds Server and Date, and the
+# body is framed again.
+GENERATED_HEADERS = {'server', 'date', 'content-length'}
+COPY_SIZE = 64 * 1024
+
+class _ProxyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if settings.settings.verbose_level > 2:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        self.__forward()
+
+    def do_HEAD(self):
+        self.__forward()
+
+    def do_POST(self):
+        self.__forward()
+
+    def do_PUT(self):
+        self.__forward()
+
+    def do_DELETE(self):
+        self.__forward()
+
+    def __route(self):
+        """Find the location and the backend path of the request.  Paths
+        which don't start with a node and location are routed using the
+        referring page, so oscilloscope's absolute asset paths still work.
+
+        Returns:
+            tuple -- The (location, path, prefix) tuple, where location is
+                     None if the request can't be routed.
+        """
+
+        front_door = self.server.front_door
+        location, path = front_door.resolve(self.path)
+        if location is None:
+            referer = self.headers.get('Referer')
+            if referer is not None:
+                location, _ = front_door.resolve(urlsplit(referer).path)
+                path = self.path
+        prefix = '/{}/{}'.format(location.log.node_name.lower(),
+                                 location.id.lower()) \
+                 if location is not None else ''
+        return location, path, prefix
+
+    def __forward(self):
+        location, path, prefix = self.__route()
+        if location is None:
+            self.send_error(404, 'Unknown node or location')
+            return
+
+        # Redirect to the trailing slash so relative asset paths resolve
+        # under the location prefix.
+        if path == '':
+            self.send_response(301)
+            self.send_header('Location', prefix + '/')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        front_door = self.server.front_door
+        front_door.acquire(location)
+        try:
+            if not front_door.start_backend(location):
+                self.send_error(503, 'Oscilloscope failed to start')
+                return
+
+            if 'upgrade' in self.headers.get('Connection', '').lower():
+                self.__tunnel(location, path)
+                return
+
+            body = None
+            length = int(self.headers.get('Content-Length', 0))
+            if length:
+                body = self.rfile.read(length)
+            headers = {k: v for k, v in self.headers.items()
+                       if k.lower() not in HOP_BY_HOP_HEADERS}
+
+            conn = http.client.HTTPConnection(
+                'localhost', location.port,
+                timeout=settings.settings.ready_timeout)
+            try:
+                conn.request(self.command, path or '/', body, headers)
+                response = conn.getresponse()
+                self.__relay(response, prefix)
+            finally:
+                conn.close()
+        except (OSError, http.client.HTTPException) as e:
+            self.send_error(502, 'Bad gateway: {}'.format(e))
+        finally:
+            front_door.release(location)
+
+    def __relay(self, response, prefix):
+        self.send_response(response.status, response.reason)
+
+        length = response.getheader('Content-Length')
+        for k, v in response.getheaders():
+            if k.lower() in HOP_BY_HOP_HEADERS \
+                    or k.lower() in GENERATED_HEADERS:
+                continue
+            if k.lower() == 'location' and v.startswith('/'):
+                v = prefix + v
+            self.send_header(k, v)
+
+        # These responses never have a body, nor the headers framing it.
+        if response.status < 200 or response.status in (204, 304):
+            self.end_headers()
+            return
+
+        if self.command == 'HEAD':
+            self.send_header('Content-Length', length or '0')
+            self.end_headers()
+            return
+
+        # Bodies are relayed as they arrive.  Those of unknown length are
+        # chunked, or delimited by closing the connection for HTTP/1.0
+        # clients.
+        chunked = False
+        if length is not None:
+            self.send_header('Content-Length', length)
+        elif self.request_version == 'HTTP/1.0':
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        else:
+            self.send_header('Transfer-Encoding', 'chunked')
+            chunked = True
+        self.end_headers()
+
+        while True:
+            data = response.read1(COPY_SIZE)
+            if not data:
+                break
+            if chunked:
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            else:
+                self.wfile.write(data)
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    def __tunnel(self, location, path):
+        """Pass a protocol upgrade, such as a WebSocket, to the backend and
+        copy the bytes both ways until either side closes the connection.
+
+        Arguments:
+            location {LogLocation} -- The location.
+            path {str} -- The backend path.
+        """
+
+        backend = socket.create_connection(
+            ('localhost', location.port),
+            timeout=settings.settings.ready_timeout)
+        backend.settimeout(None)
+        self.close_connection = True
+        try:
+            lines = ['{} {} HTTP/1.1'.format(self.command, path or '/'),
+                     'Host: localhost:{}'.format(location.port)]
+            lines += ['{}: {}'.format(k, v) for k, v in self.headers.items()
+                      if k.lower() != 'host']
+            backend.sendall(('\r\n'.join(lines) + '\r\n\r\n')
+                            .encode('latin-1'))
+
+            def to_client():
+                try:
+                    while True:
+                        data = backend.recv(COPY_SIZE)
+                        if not data:
+                            break
+                        self.wfile.write(data)
+                except OSError:
+                    pass
+                finally:
+                    # Unblocks the copy from the client.
+                    try:
+                        self.connection.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+
+            thread = Thread(target=to_client, daemon=True)
+            thread.start()
+            try:
+                while True:
+                    data = self.rfile.read1(COPY_SIZE)
+                    if not data:
+                        break
+                    backend.sendall(data)
+            except OSError:
+                pass
+            finally:
+                try:
+                    backend.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            thread.join()
+        finally:
+            backend.close()
+
+class FrontDoor(object):
+    def __init__(self, logs, port, idle_timeout):
+        """FrontDoor constructor.
+
+        Arguments:
+            logs {dict} -- The Log objects, by lowercase node name.
+            port {int} -- The port to listen on.
+            idle_timeout {int} -- Seconds after which an unused backend is
+                                  stopped.  0 disables reaping.
+        """
+
+        super().__init__()
+        self.logs = logs
+        self.port = port
+        self.idle_timeout = idle_timeout
+        self.__server = None
+        self.__threads = []
+        self.__stopped = Event()
+        self.__lock = Lock()
+        self.__active = {}
+        self.__last_used = {}
+
+    @property
+    def url(self):
+        return 'http://localhost:{}'.format(self.port)
+
+    def resolve(self, path):
+        """Find the location addressed by a request path.
+
+        Arguments:
+            path {str} -- The request path, /{node}/{location}/...
+
+        Returns:
+            tuple -- The (location, backend path) tuple, where location is
+                     None if no location matches.
+        """
+
+        parts = path.split('/', 3)
+        if len(parts) < 3:
+            return None, path
+        try:
+            location = self.logs[parts[1].lower()].locations[parts[2].lower()]
+        except KeyError:
+            return None, path
+        return location, '/' + parts[3] if len(parts) > 3 else ''
+
+    def start(self):
+        """Start serving and reaping idle backends on background threads.
+
+        Returns:
+            FrontDoor -- self
+        """
+
+        self.__server = ThreadingHTTPServer(('localhost', self.port),
+                                            _ProxyHandler)
+        self.__server.daemon_threads = True
+        self.__server.front_door = self
+
+        self.__threads = [Thread(target=self.__server.serve_forever,
+                                 daemon=True)]
+        if self.idle_timeout:
+            self.__threads.append(Thread(target=self.__reap, daemon=True))
+        for t in self.__threads:
+            t.start()
+
+        if settings.settings.verbose_level > 0:
+            print('Serving oscilloscopes on {}'.format(self.url))
+        return self
+
+    def stop(self):
+        """Stop serving.  Running backends are left to the caller.
+
+        Returns:
+            FrontDoor -- self
+        """
+
+        self.__stopped.set()
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+        for t in self.__threads:
+            t.join()
+        return self
+
+    def acquire(self, location):
+        with self.__lock:
+            self.__active[location] = self.__active.get(location, 0) + 1
+            self.__last_used[location] = time.monotonic()
+
+    def release(self, location):
+        with self.__lock:
+            self.__active[location] -= 1
+            self.__last_used[location] = time.monotonic()
+
+    def start_backend(self, location):
+        """Start the oscilloscope of a location, if needed, and wait for it
+        to accept connections.
+
+        Arguments:
+            location {LogLocation} -- The location.
+
+        Returns:
+            bool -- True if the backend is ready, False otherwise.
+        """
+
+        ExtractionCache.get_instance().touch(location)
+        return Supervisor.get_instance().start_and_wait(location)
+
+    def __reap(self):
+        interval = max(min(self.idle_timeout / 4, 30), 1)
+        while not self.__stopped.wait(interval):
+            now = time.monotonic()
+            with self.__lock:
+                idle = [location for location, used in self.__last_used.items()
+                        if not self.__active.get(location)
+                        and now - used > self.idle_timeout]
+                for location in idle:
+                    del self.__last_used[location]
+
+            for location in idle:
+                location.stop_osc(verbose=False)
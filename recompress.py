@@ -0,0 +1,126 @@
+import os
+import shutil
+import struct
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from decompress import zstandard, open_archive, SEEK_TABLE_MAGIC, \
+                       SEEKABLE_MAGIC, SEEK_TABLE_FOOTER
+
+FRAME_SIZE = 4 * 1024 * 1024
+DEFAULT_LEVEL = 3
+
+def compress_frame(data, level=DEFAULT_LEVEL):
+    """Compress data into a single zstd frame, with the zstandard module or
+    else the zstd tool.
+
+    Arguments:
+        data {bytes} -- The data.
+
+    Keyword Arguments:
+        level {int} -- The compression level. (default: {DEFAULT_LEVEL})
+
+    Raises:
+        Exception: Neither the module nor the tool is available.
+
+    Returns:
+        bytes -- The frame.
+    """
+
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+
+    exe = shutil.which('zstd')
+    if exe is None:
+        raise Exception('Recompressing needs the zstandard module or the '
+                        'zstd tool.')
+    return subprocess.run([exe, '-q', '-c', '-{}'.format(level)], input=data,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          check=True).stdout
+
+def seek_table(frames):
+    """Build the skippable frame listing the frames of a seekable zstd
+    archive.
+
+    Arguments:
+        frames {list} -- The (compressed, uncompressed) size of each frame.
+
+    Returns:
+        bytes -- The seek table frame.
+    """
+
+    entries = b''.join(struct.pack('<II', csize, usize)
+                       for csize, usize in frames)
+    footer = SEEK_TABLE_FOOTER.pack(len(frames), 0, SEEKABLE_MAGIC)
+    return struct.pack('<II', SEEK_TABLE_MAGIC,
+                       len(entries) + len(footer)) + entries + footer
+
+def read_full(stream, size):
+    """Read size bytes from the stream, unless it ends first.
+
+    Arguments:
+        stream {file} -- The stream.
+        size {int} -- The number of bytes.
+
+    Returns:
+        bytes -- The data.
+    """
+
+    chunks = []
+    while size > 0:
+        chunk = stream.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+def recompress_archive(path, destination, threads=1, level=DEFAULT_LEVEL,
+                       frame_size=FRAME_SIZE):
+    """Convert an archive of any supported format to a seekable zstd tar,
+    made of independent frames so it can be decompressed in parallel and
+    from any frame.  The frames are compressed on a thread pool.
+
+    Arguments:
+        path {str} -- The path of the archive.
+        destination {str} -- The path of the new archive, which may be the
+                             same as the archive.
+
+    Keyword Arguments:
+        threads {int} -- Number of compression threads. (default: {1})
+        level {int} -- The compression level. (default: {DEFAULT_LEVEL})
+        frame_size {int} -- Uncompressed size of each frame.
+                            (default: {FRAME_SIZE})
+
+    Returns:
+        int -- The size of the new archive.
+    """
+
+    tmp = destination + '.tmp'
+    frames = []
+    try:
+        with open_archive(path, threads) as src, open(tmp, 'wb') as dst, \
+                ThreadPoolExecutor(max_workers=threads) as executor:
+            pending = deque()
+            while True:
+                data = read_full(src, frame_size)
+                if data:
+                    pending.append((executor.submit(compress_frame, data,
+                                                    level), len(data)))
+
+                # Write the frames in order, keeping a few in flight.
+                while pending and (not data or len(pending) > threads * 2):
+                    future, usize = pending.popleft()
+                    frame = future.result()
+                    dst.write(frame)
+                    frames.append((len(frame), usize))
+                if not data:
+                    break
+            dst.write(seek_table(frames))
+        os.replace(tmp, destination)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+    return os.path.getsize(destination)
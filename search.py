@@ -0,0 +1,143 @@
+import mmap
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+
+def count_matches(path, pattern, flags=0):
+    """Count the matches of a pattern in a file, reading it through a memory
+    map so it's never copied into the process.
+
+    Arguments:
+        path {str} -- The file path.
+        pattern {bytes} -- The regular expression.
+
+    Keyword Arguments:
+        flags {int} -- The regular expression flags. (default: {0})
+
+    Returns:
+        int -- The number of matches.
+    """
+
+    p = re.compile(pattern, flags)
+    with open(path, 'rb') as f:
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped.
+            return 0
+        with m:
+            return sum(1 for _ in p.finditer(m))
+
+class TraceSearch(object):
+    """Search the trace files of the locations in parallel worker processes.
+    The hit counts are cached by file size and modification time, so
+    repeating a search only scans the files which changed."""
+
+    def __init__(self, jobs=None):
+        """TraceSearch constructor.
+
+        Keyword Arguments:
+            jobs {int} -- Number of worker processes. (default: {number of
+                          CPUs})
+        """
+
+        super().__init__()
+        self.jobs = jobs or os.cpu_count() or 1
+        self.__executor = None
+        self.__results = {}
+        self.__lock = Lock()
+
+    @staticmethod
+    def compile(pattern, regex=False, ignore_case=False):
+        """Build the regular expression searched for.
+
+        Arguments:
+            pattern {str} -- The text or regular expression.
+
+        Keyword Arguments:
+            regex {bool} -- The pattern is a regular expression.
+                            (default: {False})
+            ignore_case {bool} -- Ignore the case. (default: {False})
+
+        Raises:
+            re.error: The regular expression is invalid.
+
+        Returns:
+            tuple -- The pattern as bytes and its flags.
+        """
+
+        pattern = pattern.encode() if regex else re.escape(pattern.encode())
+        flags = re.IGNORECASE if ignore_case else 0
+        re.compile(pattern, flags)
+        return pattern, flags
+
+    def search(self, locations, pattern, flags=0):
+        """Count the matches in the trace files of the locations.  Files
+        which aren't extracted are skipped.
+
+        Arguments:
+            locations {iterable} -- The locations.
+            pattern {bytes} -- The regular expression, from compile.
+
+        Keyword Arguments:
+            flags {int} -- The regular expression flags. (default: {0})
+
+        Returns:
+            tuple -- The list of (location, hits) pairs with hits, most hits
+                     first, and the number of locations skipped.
+        """
+
+        hits = {}
+        skipped = 0
+        pending = {}
+        for location in locations:
+            files = [os.path.join(location.folder, x)
+                     for x in location.TRACE_FILES]
+            found = False
+            hits[location] = 0
+            for path in files:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found = True
+                key = (path, stat.st_size, stat.st_mtime_ns, pattern, flags)
+                with self.__lock:
+                    cached = self.__results.get(key)
+                if cached is not None:
+                    hits[location] += cached
+                else:
+                    pending[key] = location
+            if not found:
+                skipped += 1
+                del hits[location]
+
+        if pending:
+            with self.__lock:
+                if self.__executor is None:
+                    self.__executor = ProcessPoolExecutor(
+                        max_workers=self.jobs)
+                executor = self.__executor
+
+            # The largest files go first, so they don't finish last.
+            keys = sorted(pending, key=lambda x: x[1], reverse=True)
+            counts = executor.map(count_matches, [x[0] for x in keys],
+                                  [pattern] * len(keys), [flags] * len(keys))
+            for key, count in zip(keys, counts):
+                with self.__lock:
+                    self.__results[key] = count
+                hits[pending[key]] += count
+
+        ranked = sorted(((location, n) for location, n in hits.items() if n),
+                        key=lambda x: (-x[1], x[0].log.node_name,
+                                       int(x[0].id)))
+        return ranked, skipped
+
+    def close(self):
+        """Stop the worker processes."""
+
+        with self.__lock:
+            executor, self.__executor = self.__executor, None
+        if executor is not None:
+            executor.shutdown()
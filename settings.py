@@ -11,7 +11,31 @@ class Settings(object):
                 start_all=False,
                 folder_format='node%s',
                 verbose_level=1,
-                osc_path='oscilloscope.exe'):
+                osc_path='oscilloscope.exe',
+                extract_all=False,
+                buffer_size=4 * 1024 * 1024,
+                jobs=None,
+                use_processes=False,
+                decompress_threads=None,
+                external_gzip=True,
+                lazy=False,
+                proxy=False,
+                idle_timeout=600,
+                port_batch=16,
+                os_ports=False,
+                max_loading=None,
+                ready_timeout=300,
+                restart_osc=False,
+                browser_mode='tabs',
+                browser_window=0.5,
+                watch=False,
+                watch_interval=2,
+                watch_settle=5,
+                cache_budget=None,
+                daemon=False,
+                dedup=False,
+                stop_timeout=5,
+                prefetch_memory=0.5):
         if Settings.__instance is not None:
             raise Exception('Settings is a singleton class!')
 
@@ -28,11 +52,37 @@ class Settings(object):
         else:
             self.folder_format = folder_format
 
-        self.keep_archives = keep_archives
+        # Lazy mode and the extraction cache extract locations from the
+        # archives on demand, so they must be kept.
+        self.lazy = lazy
+        self.cache_budget = cache_budget
+        self.keep_archives = keep_archives or lazy or cache_budget is not None
         self.first_port = first_port
         self.start_all = start_all
         self.verbose_level = verbose_level
         self.osc_path = osc_path
+        self.extract_all = extract_all
+        self.buffer_size = buffer_size
+        self.jobs = jobs
+        self.use_processes = use_processes
+        self.decompress_threads = decompress_threads
+        self.external_gzip = external_gzip
+        self.proxy = proxy
+        self.idle_timeout = idle_timeout
+        self.port_batch = port_batch
+        self.os_ports = os_ports
+        self.max_loading = max_loading
+        self.ready_timeout = ready_timeout
+        self.restart_osc = restart_osc
+        self.browser_mode = browser_mode
+        self.browser_window = browser_window
+        self.watch = watch
+        self.watch_interval = watch_interval
+        self.watch_settle = watch_settle
+        self.daemon = daemon
+        self.dedup = dedup
+        self.stop_timeout = stop_timeout
+        self.prefetch_memory = prefetch_memory
     
     @classmethod
     def get_instance(cls):
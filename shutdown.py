@@ -0,0 +1,155 @@
+import asyncio
+import os
+import signal
+import subprocess
+from threading import Lock
+import settings
+
+# Keyword arguments starting a child in its own process group, so whatever it
+# spawns is signalled along with it.
+if os.name == 'nt':
+    GROUP_OPTIONS = {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+else:
+    GROUP_OPTIONS = {'start_new_session': True}
+
+def signal_group(proc, force=False):
+    """Signal the process group of a child started with GROUP_OPTIONS.
+
+    Arguments:
+        proc {asyncio.subprocess.Process} -- The group leader.
+
+    Keyword Arguments:
+        force {bool} -- Kill the group instead of asking it to terminate.
+                        (default: {False})
+    """
+
+    if os.name == 'nt':
+        try:
+            if force:
+                # taskkill walks the process tree, TerminateProcess doesn't.
+                subprocess.run(['taskkill', '/F', '/T', '/PID', str(proc.pid)],
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+                proc.kill()
+            else:
+                proc.send_signal(signal.CTRL_BREAK_EVENT)
+        except OSError:
+            pass
+        return
+
+    try:
+        os.killpg(proc.pid, signal.SIGKILL if force else signal.SIGTERM)
+    except OSError:
+        # The whole group is gone already.
+        pass
+
+class ShutdownManager(object):
+    """Keep track of the child processes and stop them within a deadline:
+    every process group is asked to terminate at once, the ones still
+    running at the deadline are killed, and every child is reaped."""
+
+    __instance = None
+    __instance_lock = Lock()
+
+    def __init__(self, timeout=None):
+        """ShutdownManager constructor.
+
+        Keyword Arguments:
+            timeout {float} -- Seconds a process group is given to exit
+                               before it's killed. (default: {the settings
+                               value})
+        """
+
+        if ShutdownManager.__instance is not None:
+            raise Exception('This class is a singleton!')
+
+        super().__init__()
+        self.timeout = timeout if timeout is not None \
+                       else settings.settings.stop_timeout
+        self.procs = set()
+        ShutdownManager.__instance = self
+
+    @classmethod
+    def get_instance(cls):
+        """Get the ShutdownManager instance.
+
+        Returns:
+            ShutdownManager -- the ShutdownManager instance
+        """
+
+        with cls.__instance_lock:
+            if cls.__instance is None:
+                cls()
+        return cls.__instance
+
+    def track(self, proc):
+        """Record a child process started with GROUP_OPTIONS.
+
+        Arguments:
+            proc {asyncio.subprocess.Process} -- The process.
+
+        Returns:
+            asyncio.subprocess.Process -- The process.
+        """
+
+        self.procs.add(proc)
+        return proc
+
+    def forget(self, proc):
+        """Stop tracking a child which exited on its own.  Its group is left
+        alone, as it may have handed work to processes which outlive it.
+
+        Arguments:
+            proc {asyncio.subprocess.Process} -- The process.
+        """
+
+        self.procs.discard(proc)
+
+    async def stop(self, proc, timeout=None):
+        """Ask a child's process group to terminate, kill it if it's still
+        running after the timeout, and reap the child.  Must be called on
+        the event loop the process was started on.
+
+        Arguments:
+            proc {asyncio.subprocess.Process} -- The process.
+
+        Keyword Arguments:
+            timeout {float} -- Seconds before the group is killed.
+                               (default: {self.timeout})
+
+        Returns:
+            bool -- True if the process exited gracefully, False if it was
+                    killed.
+        """
+
+        timeout = self.timeout if timeout is None else timeout
+        graceful = True
+        if proc.returncode is None:
+            signal_group(proc)
+            try:
+                await asyncio.wait_for(proc.wait(), timeout)
+            except asyncio.TimeoutError:
+                graceful = False
+                signal_group(proc, force=True)
+                await proc.wait()
+
+        # Whatever the leader left behind in its group goes with it.
+        if os.name != 'nt':
+            signal_group(proc, force=True)
+        self.procs.discard(proc)
+        return graceful
+
+    async def stop_all(self, timeout=None):
+        """Stop every tracked child in parallel.
+
+        Keyword Arguments:
+            timeout {float} -- Seconds before the groups still running are
+                               killed. (default: {self.timeout})
+
+        Returns:
+            int -- The number of children which had to be killed.
+        """
+
+        results = await asyncio.gather(*[self.stop(proc, timeout)
+                                         for proc in list(self.procs)])
+        return results.count(False)
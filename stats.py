@@ -0,0 +1,150 @@
+import json
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+PORTS = 'ports'
+
+class Stats(object):
+    """Timers and byte counters of the extraction and oscilloscope phases.
+    Each phase is counted under a scope: the node name, the location as
+    {node}.{location}, or PORTS."""
+
+    __instance = None
+    __instance_lock = Lock()
+
+    def __init__(self):
+        """Stats constructor."""
+
+        if Stats.__instance is not None:
+            raise Exception('This class is a singleton!')
+
+        super().__init__()
+        self.__entries = {}
+        self.__lock = Lock()
+        Stats.__instance = self
+
+    @classmethod
+    def get_instance(cls):
+        """Get the Stats instance.
+
+        Returns:
+            Stats -- the Stats instance
+        """
+
+        with cls.__instance_lock:
+            if cls.__instance is None:
+                cls()
+        return cls.__instance
+
+    def add(self, scope, phase, seconds=0.0, nbytes=0, count=1):
+        """Count one more run of a phase.
+
+        Arguments:
+            scope {str} -- The node, location or PORTS.
+            phase {str} -- The phase name.
+
+        Keyword Arguments:
+            seconds {float} -- Time spent in the phase. (default: {0.0})
+            nbytes {int} -- Bytes handled by the phase. (default: {0})
+            count {int} -- Number of runs. (default: {1})
+
+        Returns:
+            Stats -- self
+        """
+
+        with self.__lock:
+            entry = self.__entries.setdefault(scope, {}).setdefault(
+                phase, {'count': 0, 'seconds': 0.0, 'bytes': 0})
+            entry['count'] += count
+            entry['seconds'] += seconds
+            entry['bytes'] += nbytes
+        return self
+
+    @contextmanager
+    def timer(self, scope, phase):
+        """Time the enclosed block as a run of a phase.  The bytes it handled
+        can be set on the yielded dictionary.
+
+        Arguments:
+            scope {str} -- The node, location or PORTS.
+            phase {str} -- The phase name.
+        """
+
+        counter = {'bytes': 0}
+        started = time.perf_counter()
+        try:
+            yield counter
+        finally:
+            self.add(scope, phase, time.perf_counter() - started,
+                     counter['bytes'])
+
+    def get(self, scope):
+        """Get the phases counted under a scope.
+
+        Arguments:
+            scope {str} -- The node, location or PORTS.
+
+        Returns:
+            dict -- The count, seconds and bytes of each phase.
+        """
+
+        with self.__lock:
+            return {phase: dict(entry) for phase, entry
+                    in self.__entries.get(scope, {}).items()}
+
+    def pop(self, scope):
+        """Remove the phases counted under a scope.
+
+        Arguments:
+            scope {str} -- The node, location or PORTS.
+
+        Returns:
+            dict -- The removed phases, as returned by get.
+        """
+
+        with self.__lock:
+            return self.__entries.pop(scope, {})
+
+    def merge(self, scope, phases):
+        """Add phases counted elsewhere, e.g. in a worker process.
+
+        Arguments:
+            scope {str} -- The node, location or PORTS.
+            phases {dict} -- The phases, as returned by get.
+
+        Returns:
+            Stats -- self
+        """
+
+        for phase, entry in phases.items():
+            self.add(scope, phase, entry['seconds'], entry['bytes'],
+                     entry['count'])
+        return self
+
+    def to_dict(self):
+        """Get every counted phase.
+
+        Returns:
+            dict -- The phases of each scope.
+        """
+
+        with self.__lock:
+            return {scope: {phase: dict(entry)
+                            for phase, entry in phases.items()}
+                    for scope, phases in self.__entries.items()}
+
+    def save(self, path):
+        """Export the counters to a JSON file.
+
+        Arguments:
+            path {str} -- The file path.
+
+        Returns:
+            Stats -- self
+        """
+
+        with open(path, 'w') as f:
+            json.dump({'time': time.time(), 'scopes': self.to_dict()}, f,
+                      indent=2)
+        return self
@@ -0,0 +1,170 @@
+import errno
+import hashlib
+import os
+from threading import Lock
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+STORE_DIR = '.untar_store'
+DIGEST_SIZE = 20
+# ioctl cloning a whole file, _IOW(0x94, 9, int).
+FICLONE = 0x40049409
+
+class ContentStore(object):
+    """Keep a single copy of identical extracted files.  Each file is
+    recorded under the hash of its content, and later copies are replaced by
+    a reflink of the first one where the file system supports it, or by a
+    hardlink otherwise."""
+
+    __instance = None
+    __instance_lock = Lock()
+
+    def __init__(self, path=STORE_DIR):
+        """ContentStore constructor.
+
+        Keyword Arguments:
+            path {str} -- The store directory. (default: {STORE_DIR})
+        """
+
+        if ContentStore.__instance is not None:
+            raise Exception('This class is a singleton!')
+
+        super().__init__()
+        self.path = path
+        self.reflinks = fcntl is not None
+        ContentStore.__instance = self
+
+    @classmethod
+    def get_instance(cls):
+        """Get the ContentStore instance.
+
+        Returns:
+            ContentStore -- the ContentStore instance
+        """
+
+        with cls.__instance_lock:
+            if cls.__instance is None:
+                cls()
+        return cls.__instance
+
+    @staticmethod
+    def hasher():
+        """Get a new hash object for streaming a file's content.
+
+        Returns:
+            hashlib.blake2b -- The hash object.
+        """
+
+        return hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+    def object_path(self, digest):
+        """Get the path of the stored copy of a content.
+
+        Arguments:
+            digest {str} -- The hex digest of the content.
+
+        Returns:
+            str -- The path.
+        """
+
+        return os.path.join(self.path, digest[:2], digest[2:])
+
+    def __clone(self, src, dst):
+        # A reflink shares the blocks but stays a separate file, so it's
+        # preferred over a hardlink.
+        if self.reflinks:
+            try:
+                with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return
+            except OSError as e:
+                if os.path.exists(dst):
+                    os.remove(dst)
+                if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY,
+                                   errno.EXDEV, errno.EINVAL,
+                                   errno.EBADF, errno.ENOSYS):
+                    raise
+                self.reflinks = False
+        os.link(src, dst)
+
+    def link(self, digest, path):
+        """Place a copy of a stored content at the given path, if the store
+        has it.
+
+        Arguments:
+            digest {str} -- The hex digest of the content.
+            path {str} -- The destination path.
+
+        Returns:
+            bool -- True if the content was placed, False if it isn't
+                    stored.
+        """
+
+        stored = self.object_path(digest)
+        if not os.path.exists(stored):
+            return False
+
+        tmp = path + '.untar-tmp'
+        try:
+            self.__clone(stored, tmp)
+            os.replace(tmp, path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+        return True
+
+    def add(self, path, digest):
+        """Record a written file.  If the content is already stored, the file
+        is replaced by a copy sharing its storage.
+
+        Arguments:
+            path {str} -- The path of the file.
+            digest {str} -- The hex digest of its content.
+
+        Returns:
+            bool -- True if the file was deduplicated, False if it's the first
+                    copy of its content.
+        """
+
+        if self.link(digest, path):
+            return True
+
+        stored = self.object_path(digest)
+        try:
+            os.makedirs(os.path.dirname(stored), exist_ok=True)
+            os.link(path, stored)
+        except FileExistsError:
+            # Stored by another extraction in the meantime.
+            return self.link(digest, path)
+        except OSError:
+            # No hardlinks on this file system, nothing can be shared.
+            pass
+        return False
+
+    def prune(self):
+        """Remove the stored contents which aren't used by any extracted file
+        anymore.  Contents only shared through reflinks are removed too,
+        their copies stay valid.
+
+        Returns:
+            int -- The number of bytes freed.
+        """
+
+        freed = 0
+        if not os.path.isdir(self.path):
+            return freed
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                    if stat.st_nlink == 1:
+                        os.remove(path)
+                        freed += stat.st_size
+                except OSError:
+                    pass
+        return freed
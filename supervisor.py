@@ -0,0 +1,359 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import os
+import subprocess
+from threading import Thread, Lock
+import settings
+from browser import BrowserLauncher
+from prefetch import Prefetcher
+from shutdown import GROUP_OPTIONS, ShutdownManager
+from stats import Stats
+from utils import get_next_free_port, release_port
+
+LOADING = 'loading'
+READY = 'ready'
+DEAD = 'dead'
+
+POLL_INTERVAL = 0.2
+MAX_RESTARTS = 3
+
+# List collecting the futures submitted in the current context, if set.
+submitted = contextvars.ContextVar('submitted', default=None)
+
+class Supervisor(object):
+    """Start, watch and stop the oscilloscope processes on a single asyncio
+    event loop running in a background thread, so the CLI never waits on a
+    launch and a few threads serve any number of processes."""
+
+    __instance = None
+    __instance_lock = Lock()
+
+    def __init__(self):
+        """Supervisor constructor."""
+
+        if Supervisor.__instance is not None:
+            raise Exception('This class is a singleton!')
+
+        super().__init__()
+        self.max_loading = settings.settings.max_loading \
+                           or max((os.cpu_count() or 1) // 2, 1)
+        self.browser = BrowserLauncher(settings.settings.browser_mode,
+                                       settings.settings.browser_window)
+        self.__loop = asyncio.new_event_loop()
+        self.__loading = None
+        self.__thread = Thread(target=self.__run_loop, daemon=True)
+        self.__thread.start()
+        Supervisor.__instance = self
+
+    @classmethod
+    def get_instance(cls):
+        """Get the Supervisor instance.
+
+        Returns:
+            Supervisor -- the Supervisor instance
+        """
+
+        with cls.__instance_lock:
+            if cls.__instance is None:
+                cls()
+        return cls.__instance
+
+    def __run_loop(self):
+        asyncio.set_event_loop(self.__loop)
+        self.__loading = asyncio.Semaphore(self.max_loading)
+        self.__loop.run_forever()
+
+    def submit(self, coro):
+        """Schedule a coroutine on the supervisor loop.  It runs in a copy
+        of the caller's context.
+
+        Arguments:
+            coro {coroutine} -- The coroutine.
+
+        Returns:
+            concurrent.futures.Future -- The future of its result.
+        """
+
+        future = asyncio.run_coroutine_threadsafe(coro, self.__loop)
+        future.add_done_callback(self.__report)
+        futures = submitted.get()
+        if futures is not None:
+            futures.append(future)
+        return future
+
+    @staticmethod
+    def __report(future):
+        # Nothing may be waiting for the result, the errors would be lost.
+        if future.cancelled():
+            return
+        e = future.exception()
+        if e is not None:
+            print('Oscilloscope task failed: {}'.format(e))
+
+    def start(self, location, open_browser=True):
+        """Queue the start of a location's oscilloscope without waiting for
+        it.
+
+        Arguments:
+            location {LogLocation} -- The location.
+
+        Keyword Arguments:
+            open_browser {bool} -- Open the browser once it's ready.
+                                   (default: {True})
+
+        Returns:
+            concurrent.futures.Future -- Resolves to True once the
+                                         oscilloscope is ready, or False if it
+                                         failed to start.
+        """
+
+        return self.submit(self.__start_task(location, open_browser))
+
+    def start_and_wait(self, location):
+        """Start a location's oscilloscope, if needed, and wait until it
+        accepts connections.
+
+        Arguments:
+            location {LogLocation} -- The location.
+
+        Returns:
+            bool -- True if the oscilloscope is ready, False otherwise.
+        """
+
+        try:
+            return self.start(location, open_browser=False).result()
+        except (asyncio.CancelledError, concurrent.futures.CancelledError):
+            return False
+
+    def stop(self, location, verbose=True):
+        """Stop a location's oscilloscope, cancelling its start if it's
+        still queued, and wait until the process is reaped.
+
+        Arguments:
+            location {LogLocation} -- The location.
+
+        Keyword Arguments:
+            verbose {bool} -- Report locations which aren't running.
+                              (default: {True})
+        """
+
+        self.submit(self.stop_async(location, verbose)).result()
+
+    def stop_all(self, locations):
+        """Stop the oscilloscopes of all the given locations concurrently.
+
+        Arguments:
+            locations {iterable} -- The locations.
+        """
+
+        async def stop_all():
+            await asyncio.gather(*[self.stop_async(location, False)
+                                   for location in locations])
+        self.submit(stop_all()).result()
+
+    def shutdown(self, locations):
+        """Stop the oscilloscopes of all the given locations and every
+        other child still running, such as browser launchers, within the
+        stop timeout.
+
+        Arguments:
+            locations {iterable} -- The locations.
+        """
+
+        async def shutdown():
+            self.browser.close()
+            await asyncio.gather(*[self.stop_async(location, False)
+                                   for location in locations])
+            killed = await ShutdownManager.get_instance().stop_all()
+            if killed and settings.settings.verbose_level > 0:
+                print('Killed {} processes which did not exit in time.'
+                      .format(killed))
+        self.submit(shutdown()).result()
+
+    async def __start_task(self, location, open_browser):
+        # Starting twice joins the pending start instead of queueing another.
+        task = location.osc_task
+        if task is None or task.done():
+            if location.osc_state == READY and location.osc_proc is not None:
+                return True
+            task = asyncio.ensure_future(self.__start(location))
+            location.osc_task = task
+
+        ready = await asyncio.shield(task)
+        if ready and open_browser:
+            await self.open_browser(location)
+        return ready
+
+    async def __start(self, location):
+        # Once the start ends, the warmed trace files are loaded or won't be.
+        try:
+            return await self.__launch(location)
+        finally:
+            Prefetcher.get_instance().release(location)
+
+    async def __launch(self, location):
+        loop = asyncio.get_running_loop()
+        stats = Stats.get_instance()
+        scope = '{}.{}'.format(location.log.node_name, location.id)
+        queued = loop.time()
+        async with self.__loading:
+            stats.add(scope, 'queue_wait', loop.time() - queued)
+            # Lazily indexed locations are extracted first, off the loop.
+            try:
+                await loop.run_in_executor(None,
+                                           contextvars.copy_context().run,
+                                           location.ensure_extracted)
+            except Exception as e:
+                print('Could not extract {}.{}: {}'.format(
+                    location.log.node_name, location.id, e))
+                self.__mark_dead(location)
+                return False
+            if location.port is None:
+                location.port = get_next_free_port()
+
+            location.osc_state = LOADING
+            location.osc_started = loop.time()
+            location.osc_load_time = None
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *location.osc_command(),
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.STDOUT,
+                    **GROUP_OPTIONS)
+            except OSError as e:
+                print('Could not start oscilloscope on {}.{}: {}'.format(
+                    location.log.node_name, location.id, e))
+                self.__mark_dead(location)
+                return False
+            location.osc_proc = proc
+            ShutdownManager.get_instance().track(proc)
+            loop.create_task(self.__watch(location, proc))
+
+            return await self.__wait_ready(location, proc)
+
+    def __mark_dead(self, location):
+        location.osc_state = DEAD
+        if location.port is not None:
+            release_port(location.port)
+            location.port = None
+
+    async def __wait_ready(self, location, proc):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + settings.settings.ready_timeout
+        while proc.returncode is None:
+            try:
+                _, writer = await asyncio.open_connection('localhost',
+                                                          location.port)
+                writer.close()
+                break
+            except OSError:
+                pass
+            if loop.time() > deadline:
+                print('Oscilloscope on {}.{} is not ready after {}s.'.format(
+                    location.log.node_name, location.id,
+                    settings.settings.ready_timeout))
+                return False
+            await asyncio.sleep(POLL_INTERVAL)
+        else:
+            return False
+
+        location.osc_state = READY
+        location.osc_load_time = loop.time() - location.osc_started
+        Stats.get_instance().add(
+            '{}.{}'.format(location.log.node_name, location.id), 'ready',
+            location.osc_load_time)
+        if settings.settings.verbose_level > 1:
+            print('Oscilloscope on {}.{} ready in {:.1f}s.'.format(
+                location.log.node_name, location.id, location.osc_load_time))
+        return True
+
+    async def __watch(self, location, proc):
+        returncode = await proc.wait()
+
+        # Stopped on purpose, or replaced by a newer process.
+        if location.osc_proc is not proc:
+            return
+        ShutdownManager.get_instance().forget(proc)
+
+        location.osc_state = DEAD
+        print('Oscilloscope on {}.{} exited with code {}.'.format(
+            location.log.node_name, location.id, returncode))
+        if settings.settings.restart_osc \
+                and location.osc_restarts < MAX_RESTARTS:
+            location.osc_restarts += 1
+            if settings.settings.verbose_level > 0:
+                print('Restarting oscilloscope on {}.{}.'.format(
+                    location.log.node_name, location.id))
+
+            # The port is kept, so the open tabs can reconnect.
+            location.osc_proc = None
+            await self.__start_task(location, False)
+            return
+
+        # Left dead, so it can be started again on a new port.
+        self.browser.remove('{}.{}'.format(location.log.node_name.capitalize(),
+                                           location.id.capitalize()))
+        location.osc_proc = None
+        release_port(location.port)
+        location.port = None
+
+    async def open_browser(self, location):
+        """Queue the oscilloscope of a location to be opened in the browser.
+
+        Arguments:
+            location {LogLocation} -- The location.
+        """
+
+        label = '{}.{}'.format(location.log.node_name.capitalize(),
+                               location.id.capitalize())
+        print('{} -> {}'.format(label, location.url))
+        self.browser.open(label, location.url)
+
+    async def stop_async(self, location, verbose=True):
+        """Stop a location's oscilloscope and reap its process.  Its process
+        group is asked to terminate and killed if it's still running after
+        the stop timeout.
+
+        Arguments:
+            location {LogLocation} -- The location.
+
+        Keyword Arguments:
+            verbose {bool} -- Report locations which aren't running.
+                              (default: {True})
+        """
+
+        task = location.osc_task
+        if task is not None and not task.done():
+            task.cancel()
+        location.osc_task = None
+
+        proc = location.osc_proc
+        if proc is None:
+            # A start cancelled before spawning may still hold a port.
+            if location.port is not None:
+                release_port(location.port)
+                location.port = None
+            if verbose:
+                print('Oscilloscope not running on {}.{}'.format(
+                    location.log.node_name, location.id))
+            return
+
+        print('Stopping oscilloscope on {}.{}'.format(location.log.node_name,
+                                                      location.id))
+        self.browser.remove('{}.{}'.format(location.log.node_name.capitalize(),
+                                           location.id.capitalize()))
+        location.osc_proc = None
+        location.osc_state = None
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        graceful = await ShutdownManager.get_instance().stop(proc)
+        if not graceful and settings.settings.verbose_level > 0:
+            print('Killed oscilloscope on {}.{} after {}s.'.format(
+                location.log.node_name, location.id,
+                settings.settings.stop_timeout))
+        release_port(location.port)
+        location.port = None
+        Stats.get_instance().add(
+            '{}.{}'.format(location.log.node_name, location.id), 'stop',
+            loop.time() - started)
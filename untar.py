@@ -1,6 +1,7 @@
 import atexit
 import argparse
 from app import App
+from daemon import ControlServer, DaemonClient, supported
 import settings
 from settings import Settings
 import utils
@@ -18,12 +19,46 @@ def build_parser():
 
     parser.add_argument('--start-all', '-s', action="store_true", help="Start oscilloscope on all nodes right away")
     parser.add_argument("--port", '-p', default=8080, type=int, help="First port to use")
-    parser.add_argument("--keep", '-k', action="store_true", help="Keep .tgz files")
+    parser.add_argument("--keep", '-k', action="store_true", help="Keep the archives")
+    parser.add_argument("--jobs", '-j', default=None, type=int, help="Number of archives extracted at the same time (default: number of CPUs)")
+    parser.add_argument("--processes", action="store_true", help="Extract archives in worker processes instead of threads")
+    parser.add_argument("--decompress-threads", default=None, type=int, help="Number of threads used to decompress each archive (default: number of CPUs)")
+    parser.add_argument("--no-external-gzip", action="store_true", help="Never use a system pigz/igzip binary for decompression")
+    parser.add_argument("--lazy", '-l', action="store_true", help="Only index the archives at startup and extract each location when oscilloscope is first started on it (implies --keep)")
+    parser.add_argument("--proxy", action="store_true", help="Serve every oscilloscope through a single port, starting each one on its first request")
+    parser.add_argument("--idle-timeout", default=600, type=int, help="Seconds after which an unused oscilloscope is stopped when using --proxy, 0 to never stop them (default: %(default)s)")
+    parser.add_argument("--os-ports", action="store_true", help="Let the OS assign the oscilloscope ports instead of counting up from --port")
+    parser.add_argument("--max-loading", default=None, type=int, help="Number of oscilloscopes loading their traces at the same time (default: half the number of CPUs)")
+    parser.add_argument("--ready-timeout", default=300, type=int, help="Seconds to wait for an oscilloscope to start listening (default: %(default)s)")
+    parser.add_argument("--restart", action="store_true", help="Restart oscilloscopes which exit unexpectedly")
+    parser.add_argument("--browser-mode", default='tabs', choices=['tabs', 'index'], help="Open each oscilloscope in its own tab, or a single page linking all of them (default: %(default)s)")
+    parser.add_argument("--browser-window", default=0.5, type=float, help="Seconds during which ready oscilloscopes are collected before opening the browser once for all of them (default: %(default)s)")
+    parser.add_argument("--watch", '-w', action="store_true", help="Keep watching for new archives and extract them in the background (with --start-all, also start oscilloscope on them)")
+    parser.add_argument("--watch-settle", default=5, type=float, help="Seconds an archive must stop growing before it's extracted in watch mode (default: %(default)s)")
+    parser.add_argument("--cache-budget", default=None, type=float, help="Disk space in MiB the extracted locations may use.  The least recently viewed ones are removed when it's exceeded and extracted again when next started (implies --keep)")
+    parser.add_argument("--daemon", '-d', action="store_true", help="Serve the workspace to every CLI session started in it, sharing the extractions and oscilloscopes (needs Unix domain sockets)")
+    parser.add_argument("--dedup", action="store_true", help="Store identical extracted files once, as reflinks where the file system supports them or else hardlinks (hardlinked copies share their changes)")
+    parser.add_argument("--stop-timeout", default=5, type=float, help="Seconds an oscilloscope is given to exit once asked to stop, before it's killed (default: %(default)s)")
+    parser.add_argument("--prefetch-memory", default=0.5, type=float, help="Share of the available memory used to read the trace files of queued locations ahead of their oscilloscope, 0 to disable (default: %(default)s)")
+    parser.add_argument("--extract-all", '-a', action="store_true", help="Extract every file in the archives, not only the trace files")
 
     return parser
 
 def main():
+    # A CLI started next to a daemon only forwards the commands to it.
+    if not settings.settings.daemon:
+        client = DaemonClient.connect()
+        if client is not None:
+            client.cmdloop()
+            return
+
     utils.init()
+    if settings.settings.daemon:
+        if not supported():
+            print('Daemon mode is not supported on this platform.')
+        else:
+            ControlServer(App()).serve()
+            return
     App().cmdloop()
             
 if __name__ == "__main__":
@@ -31,5 +66,27 @@ if __name__ == "__main__":
     settings.settings = Settings(browser=args.browser,
                                  keep_archives=args.keep,
                                  first_port=args.port,
-                                 start_all=args.start_all)
+                                 start_all=args.start_all,
+                                 extract_all=args.extract_all,
+                                 jobs=args.jobs,
+                                 use_processes=args.processes,
+                                 decompress_threads=args.decompress_threads,
+                                 external_gzip=not args.no_external_gzip,
+                                 lazy=args.lazy,
+                                 proxy=args.proxy,
+                                 idle_timeout=args.idle_timeout,
+                                 os_ports=args.os_ports,
+                                 max_loading=args.max_loading,
+                                 ready_timeout=args.ready_timeout,
+                                 restart_osc=args.restart,
+                                 browser_mode=args.browser_mode,
+                                 browser_window=args.browser_window,
+                                 watch=args.watch,
+                                 watch_settle=args.watch_settle,
+                                 cache_budget=None if args.cache_budget is None
+                                 else int(args.cache_budget * 1024 * 1024),
+                                 daemon=args.daemon,
+                                 dedup=args.dedup,
+                                 stop_timeout=args.stop_timeout,
+                                 prefetch_memory=args.prefetch_memory)
     main()
@@ -1,30 +1,134 @@
 import socket
 import settings
+from stats import Stats, PORTS
+from collections import deque
 from threading import Lock
 
-__next_free_port = None
-__lock = Lock()
+__allocator = None
 
-def init():
-    """Initialize module variables."""
+class PortAllocator(object):
+    MAX_PORT = 65535
 
-    assert(settings.settings is not None)
-    global __next_free_port
+    def __init__(self, first_port, batch_size=16, os_ports=False):
+        """PortAllocator constructor.
 
-    __next_free_port = settings.settings.first_port
+        Arguments:
+            first_port {int} -- The first port to hand out.
 
-def is_port_in_use(port):
-    """Check if the given port is being used.
+        Keyword Arguments:
+            batch_size {int} -- Number of ports reserved at once.
+                                (default: {16})
+            os_ports {bool} -- Let the OS pick the ports instead of counting
+                               up from first_port. (default: {False})
+        """
 
-    Arguments:
-        port {int} -- Port to be tested.
+        super().__init__()
+        self.first_port = first_port
+        self.batch_size = batch_size
+        self.os_ports = os_ports
+        self.__next_port = first_port
+        self.__reserved = deque()
+        self.__allocated = set()
+        self.__lock = Lock()
 
-    Returns:
-        bool -- True if used, False otherwise.
-    """
+    @staticmethod
+    def reserve(port):
+        """Reserve a port by binding a socket to it.
+
+        Arguments:
+            port {int} -- The port, or 0 to let the OS pick one.
+
+        Returns:
+            {None, socket} -- The bound socket, or None if the port is taken.
+        """
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.bind(('localhost', port))
+        except OSError:
+            s.close()
+            return None
+        return s
+
+    def __reserve_batch(self):
+        # Claim a range of candidates under the lock, then bind them without
+        # holding it so concurrent allocations don't wait on each other.
+        with self.__lock:
+            start = self.__next_port
+            end = min(start + self.batch_size, self.MAX_PORT + 1)
+            self.__next_port = end
+        if not self.os_ports and start > self.MAX_PORT:
+            raise Exception('No free ports left.')
+
+        batch = []
+        if self.os_ports:
+            for _ in range(self.batch_size):
+                s = self.reserve(0)
+                if s is not None:
+                    batch.append((s.getsockname()[1], s))
+        else:
+            for port in range(start, end):
+                s = self.reserve(port)
+                if s is not None:
+                    batch.append((port, s))
+
+        with self.__lock:
+            self.__reserved.extend(batch)
+
+    def allocate(self):
+        """Hand out a reserved port.  Its socket is closed right before it's
+        returned, so it can be bound by the caller.
+
+        Returns:
+            int -- The port.
+        """
+
+        while True:
+            with self.__lock:
+                if self.__reserved:
+                    port, s = self.__reserved.popleft()
+                    s.close()
+                    self.__allocated.add(port)
+                    return port
+            self.__reserve_batch()
 
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        return s.connect_ex(('localhost', port)) == 0
+    def release(self, port):
+        """Take back an allocated port, reserving it again for the next
+        allocation if it's free.
+
+        Arguments:
+            port {int} -- The port.
+        """
+
+        with self.__lock:
+            if port not in self.__allocated:
+                return
+            self.__allocated.remove(port)
+
+        s = self.reserve(port)
+        if s is not None:
+            with self.__lock:
+                self.__reserved.appendleft((port, s))
+
+    def close(self):
+        """Release all the reserved ports."""
+
+        with self.__lock:
+            while self.__reserved:
+                self.__reserved.popleft()[1].close()
+
+def init():
+    """Initialize module variables."""
+
+    assert(settings.settings is not None)
+    global __allocator
+
+    # The first port belongs to the front door when it's enabled.
+    first_port = settings.settings.first_port
+    if settings.settings.proxy:
+        first_port += 1
+    __allocator = PortAllocator(first_port, settings.settings.port_batch,
+                                settings.settings.os_ports)
 
 def get_next_free_port():
     """Get the first available port.
@@ -32,13 +136,15 @@ def get_next_free_port():
     Returns:
         int -- The first port available
     """
-    
-    global __next_free_port
 
-    with __lock:
-        port = __next_free_port
-        while is_port_in_use(port):
-            port += 1
-        __next_free_port = port + 1
+    with Stats.get_instance().timer(PORTS, 'allocate'):
+        return __allocator.allocate()
+
+def release_port(port):
+    """Give back a port obtained from get_next_free_port.
+
+    Arguments:
+        port {int} -- The port.
+    """
 
-    return port
\ No newline at end of file
+    __allocator.release(port)
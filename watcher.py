@@ -0,0 +1,198 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Event
+import settings
+from log import Log
+
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+EVENT_HEADER = struct.Struct('iIII')
+
+class _Inotify(object):
+    """Minimal inotify binding, watching a single directory."""
+
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = IN_CREATE | IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, 'inotify_add_watch failed')
+
+    def wait(self, timeout):
+        """Wait for events on the directory.
+
+        Arguments:
+            timeout {float} -- Maximum number of seconds to wait.
+
+        Returns:
+            set -- The names of the files which changed.
+        """
+
+        names = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return names
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return names
+
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            _, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if name:
+                names.add(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+class ArchiveWatcher(object):
+    """Watch the workspace for new or replaced node archives while the CLI
+    runs, and ingest each one in the background once it stops growing."""
+
+    def __init__(self, app, path='.'):
+        """ArchiveWatcher constructor.
+
+        Arguments:
+            app {App} -- The application the new nodes are registered in.
+
+        Keyword Arguments:
+            path {str} -- The watched directory. (default: {'.'})
+        """
+
+        super().__init__()
+        self.app = app
+        self.path = path
+        self.archive_regex = Log.ARCHIVE_REGEX
+        self.__stopped = Event()
+        self.__thread = None
+        self.__executor = None
+        self.__inotify = None
+        self.__pending = {}
+        self.__ingested = {}
+
+    def start(self):
+        """Start watching on a background thread.  The archives which exist
+        at this point are considered already handled.
+
+        Returns:
+            ArchiveWatcher -- self
+        """
+
+        for name in self.__list_archives():
+            self.__ingested[name] = self.__stat(name)
+
+        try:
+            self.__inotify = _Inotify(self.path)
+        except (OSError, AttributeError, TypeError):
+            # No inotify on this platform, the directory is polled instead.
+            self.__inotify = None
+
+        self.__executor = ThreadPoolExecutor(
+            max_workers=settings.settings.jobs or os.cpu_count() or 1)
+        self.__thread = Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+        if settings.settings.verbose_level > 0:
+            print('Watching for new archives ({}).'.format(
+                'inotify' if self.__inotify is not None else 'polling'))
+        return self
+
+    def stop(self):
+        """Stop watching and wait for the running ingestions.
+
+        Returns:
+            ArchiveWatcher -- self
+        """
+
+        self.__stopped.set()
+        if self.__thread is not None:
+            self.__thread.join()
+        if self.__executor is not None:
+            self.__executor.shutdown(cancel_futures=True)
+        if self.__inotify is not None:
+            self.__inotify.close()
+        return self
+
+    def ignore(self, name):
+        """Consider an archive handled as it currently is, e.g. when the
+        application rewrote it itself.
+
+        Arguments:
+            name {str} -- The name of the archive.
+
+        Returns:
+            ArchiveWatcher -- self
+        """
+
+        self.__ingested[name] = self.__stat(name)
+        return self
+
+    def __list_archives(self):
+        with os.scandir(self.path) as it:
+            return [entry.name for entry in it
+                    if self.archive_regex.match(entry.name)
+                    and entry.is_file()]
+
+    def __stat(self, name):
+        try:
+            stat = os.stat(os.path.join(self.path, name))
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def __run(self):
+        interval = settings.settings.watch_interval
+        while not self.__stopped.is_set():
+            if self.__inotify is not None:
+                names = self.__inotify.wait(interval)
+                names = [x for x in names if self.archive_regex.match(x)]
+            else:
+                self.__stopped.wait(interval)
+                names = self.__list_archives()
+
+            now = time.monotonic()
+            for name in names:
+                stat = self.__stat(name)
+                if stat is not None and stat != self.__ingested.get(name) \
+                        and name not in self.__pending:
+                    self.__pending[name] = (stat, now)
+
+            self.__check_pending(now)
+
+    def __check_pending(self, now):
+        # An archive is ingested once its size and mtime stayed the same for
+        # the settle time, unless it was ignored meanwhile.
+        for name, (last_stat, changed) in list(self.__pending.items()):
+            stat = self.__stat(name)
+            if stat is None or stat == self.__ingested.get(name):
+                del self.__pending[name]
+            elif stat != last_stat:
+                self.__pending[name] = (stat, now)
+            elif now - changed >= settings.settings.watch_settle:
+                del self.__pending[name]
+                self.__ingested[name] = stat
+                self.__executor.submit(self.__ingest, name)
+
+    def __ingest(self, name):
+        try:
+            self.app.ingest_archive(name)
+        except Exception as e:
+            print('Failed to ingest {}: {}'.format(name, e))